@@ -0,0 +1,126 @@
+"""
+Extract the failed operations of finished import batches into a retry CSV
+
+Usage:
+    python3 batch_errors.py SOURCE_CSV BATCH_ID [BATCH_ID ...]
+
+The response archive of every batch is streamed (never held fully in memory or
+on disk) and each failed operation is classified by status code and error title.
+Writes:
+
+    - `<SOURCE_CSV stem>-errors.csv`: one line per failed operation (email, status, title, detail)
+    - `<SOURCE_CSV stem>-retry.csv`: the rows of SOURCE_CSV whose operation failed with a
+      retryable error, with the same columns, so it can be passed straight back to
+      `create_members_list_batch` (or listed in audience.csv) for resubmission.
+      Compressed like new segment files (see segment_io.py); SOURCE_CSV may be
+      plain or compressed.
+
+Relies on the email being used as operation_id (see build_member_operations).
+
+"""
+
+import sys
+import csv, ujson
+import requests
+import tarfile
+from collections import Counter
+
+# Errors that will fail again no matter how often they are resubmitted
+NON_RETRYABLE_TITLES = ['Member Exists', 'Invalid Resource', 'Forgotten Email Not Subscribed']
+
+# MailChimp client, built on first use
+from mailchimp_client import client
+import segment_io
+
+
+def iter_batch_responses(response_url):
+    """ Generator over every operation response inside a batch response archive
+
+    The tar.gz is read straight from the HTTP stream, one JSON file at a time.
+    """
+
+    r = requests.get(response_url, stream=True, allow_redirects=True)
+    r.raise_for_status()
+    r.raw.decode_content = True
+    with tarfile.open(fileobj=r.raw, mode='r|gz') as archive:
+        for member in archive:
+            if not member.isfile() or not member.name.endswith('.json'):
+                continue
+            for response in ujson.load(archive.extractfile(member)):
+                yield response
+
+    return
+
+
+def iter_failed_operations(batchid):
+    """ Generator over (operation_id, status_code, title, detail) of failed operations
+    """
+
+    batch = client.batch_operations.get(batchid)
+    if batch['status'] != 'finished':
+        print('Batch', batchid, 'is not finished yet (', batch['status'], '), skipping')
+        return
+    if batch['errored_operations'] == 0:
+        return
+
+    for response in iter_batch_responses(batch['response_body_url']):
+        status_code = response['status_code']
+        if status_code < 400:
+            continue
+        try:
+            body = ujson.loads(response['response'])
+        except ValueError:
+            body = {}
+        yield response['operation_id'], status_code, body.get('title', ''), body.get('detail', '')
+
+    return
+
+
+def write_retry_files(source_csv, batch_ids):
+    """ Classify the failures of all batches and write the errors and retry files
+
+    Returns the Counter of (status_code, title) over all failed operations.
+    """
+
+    stem = segment_io.strip_compression(source_csv).rsplit('.', 1)[0]
+    errors_csv = stem + '-errors.csv'
+    retry_csv = segment_io.segment_file(stem + '-retry.csv')
+
+    classes = Counter()
+    retry_emails = set()
+    with open(errors_csv, 'w', encoding='utf-8-sig', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['email_address', 'status_code', 'title', 'detail'])
+        for batchid in batch_ids:
+            for email, status_code, title, detail in iter_failed_operations(batchid):
+                writer.writerow([email, status_code, title, detail])
+                classes[(status_code, title)] += 1
+                if title not in NON_RETRYABLE_TITLES and email:
+                    retry_emails.add(email.strip().lower())
+
+    n_retry = 0
+    with segment_io.open_segment(source_csv) as fin, segment_io.write_segment_atomic(retry_csv) as fout:
+        reader = csv.DictReader(fin, skipinitialspace=True)
+        writer = csv.DictWriter(fout, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        for row in reader:
+            if row['email_address'].strip().lower() in retry_emails:
+                writer.writerow(row)
+                n_retry += 1
+
+    print('Failed operations by status and title:')
+    for (status_code, title), n in classes.most_common():
+        print('{:>8}  {}  {}'.format(n, status_code, title))
+    print()
+    print('Errors written to', errors_csv)
+    print(n_retry, 'rows to retry written to', retry_csv)
+
+    return classes
+
+
+# MAIN
+if __name__ == "__main__":
+
+    source_file = sys.argv[1]
+    all_batch_ids = sys.argv[2:]
+    write_retry_files(source_file, all_batch_ids)
@@ -0,0 +1,267 @@
+"""
+Benchmarks for deduplication, merging and import-building on synthetic segments
+
+Usage:
+    python3 benchmark.py [--size small|medium|large|ROWS] [--segments 20] [--overlap 0.3]
+                         [--stages dedup merge import] [--repeat 1] [--keep-data]
+    python3 benchmark.py --compare OLD.json NEW.json
+    python3 benchmark.py --startup
+
+Segment CSVs with the export column schema are generated under BENCHMARK_DATA_DIR
+(sizes follow a long tail, like the real segments; `--overlap` is the fraction of
+each segment's rows that also appear in other segments). Every stage runs in a
+fresh subprocess on a fresh copy of the data, so its wall time and peak RSS are
+not affected by the other stages. Results are saved as JSON in
+BENCHMARK_RESULTS_DIR, tagged with the git revision, for comparison across versions.
+
+`--startup` instead times importing the quick entry points in a fresh interpreter
+and fails (exit code 1) if one of them loads a heavy module or exceeds
+STARTUP_BUDGET seconds over a bare interpreter.
+
+"""
+
+import os, sys, time
+import csv, ujson
+import random
+import shutil
+import argparse
+import resource
+import subprocess
+import contextlib
+from pathlib import Path
+
+BENCHMARK_DATA_DIR = './benchmark_data'
+BENCHMARK_RESULTS_DIR = './benchmark_results'
+SIZES = {'small': 10000, 'medium': 1000000, 'large': 10000000}
+HEADERS = ['email_address', 'status', 'FNAME', 'LNAME', 'PROVINCE', 'CITY', 'ZIP_CODE', 'MAKE', 'MODEL', 'YEAR']
+PROVINCES = ['ON', 'QC', 'BC', 'AB', 'MB', 'SK', 'NS', 'NB', 'NL', 'PE']
+MAKES = {'TOYOTA': ['COROLLA', 'CAMRY', 'RAV4', 'TACOMA'], 'HONDA': ['CIVIC', 'ACCORD', 'CR-V', 'ODYSSEY'],
+         'FORD': ['F-150', 'ESCAPE', 'FOCUS', 'EXPLORER'], 'CHEVROLET': ['SILVERADO', 'EQUINOX', 'CRUZE', 'MALIBU'],
+         'NISSAN': ['ALTIMA', 'ROGUE', 'SENTRA'], 'HYUNDAI': ['ELANTRA', 'TUCSON', 'SANTA FE']}
+ALL_STAGES = ['dedup', 'merge', 'import']
+STARTUP_MODULES = ['check_batch', 'check_batch_operation', 'poll_batches', 'export_segments']
+HEAVY_MODULES = ['pandas', 'numpy', 'tqdm', 'mailchimp3', 'requests']
+STARTUP_BUDGET = 0.15
+
+
+def synthetic_member(i):
+    """ Deterministic member row number i, with the export column schema """
+
+    rnd = random.Random(i)
+    make = rnd.choice(sorted(MAKES))
+    # Some blank years, like the real exports
+    year = '' if rnd.random() < 0.05 else str(rnd.randint(1990, 2020))
+    zip_code = '{}{}{} {}{}{}'.format(rnd.choice('ABCEGHJKLMNPRSTVXY'), rnd.randint(0, 9), rnd.choice('ABCEGHJKLMNPRSTVWXYZ'),
+                                      rnd.randint(0, 9), rnd.choice('ABCEGHJKLMNPRSTVWXYZ'), rnd.randint(0, 9))
+
+    return ['customer{}@example.com'.format(i), 'subscribed', 'First{}'.format(rnd.randint(0, 5000)),
+            'Last{}'.format(rnd.randint(0, 20000)), rnd.choice(PROVINCES), 'City{}'.format(rnd.randint(0, 800)),
+            zip_code, make, rnd.choice(MAKES[make]), year]
+
+
+def generate_segments(total_rows, n_segments, overlap, data_dir, seed=0):
+    """ Write n_segments CSV files with total_rows rows in all to data_dir
+
+    Segment sizes are proportional to 1/(k+1). A fraction `overlap` of the rows of
+    every segment is drawn from a pool shared by all segments, the rest is unique
+    to the segment. Returns the list of file names.
+    """
+
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    weights = [1.0 / (k + 1) for k in range(n_segments)]
+    sizes = [max(1, int(total_rows * w / sum(weights))) for w in weights]
+    shared_pool = max(1, int(total_rows * overlap / 2))
+    rnd = random.Random(seed)
+    next_unique = shared_pool
+
+    all_segments_csv = []
+    for k, size in enumerate(sizes):
+        filename = 'Segment{:03d}.csv'.format(k)
+        n_shared = int(size * overlap)
+        shared = rnd.sample(range(shared_pool), min(n_shared, shared_pool))
+        ids = shared + list(range(next_unique, next_unique + size - len(shared)))
+        next_unique += size - len(shared)
+        with open(os.path.join(data_dir, filename), 'w', encoding='utf-8-sig', newline='') as fp:
+            writer = csv.writer(fp)
+            writer.writerow(HEADERS)
+            for i in ids:
+                writer.writerow(synthetic_member(i))
+        all_segments_csv.append(filename)
+
+    return all_segments_csv
+
+
+def run_stage(stage, data_dir, work_dir):
+    """ Run one stage on a copy of data_dir; called in a fresh subprocess
+
+    Returns a dictionary with wall time, rows processed and peak RSS.
+    """
+
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    shutil.copytree(data_dir, work_dir)
+    os.chdir(work_dir)
+    all_segments_csv = sorted(x for x in os.listdir('.') if x.endswith('.csv'))
+    rows = sum(sum(1 for _ in open(x, encoding='utf-8-sig')) - 1 for x in all_segments_csv)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if stage == 'dedup':
+            import deduplication
+            start = time.perf_counter()
+            all_segments_in_order = deduplication.assign_priority_segments_by_size(all_segments_csv)
+            deduplication.remove_duplicates_by_priority(all_segments_in_order)
+        elif stage == 'merge':
+            import deduplication
+            start = time.perf_counter()
+            deduplication.merge_segments_create_audience(all_segments_csv, 'merged_audience.csv.out')
+        elif stage == 'import':
+            import write_audience_members
+            start = time.perf_counter()
+            for csvfile in all_segments_csv:
+                for _ in write_audience_members.build_member_operations('0000000000', csvfile):
+                    pass
+        else:
+            raise ValueError('Unknown stage ' + stage)
+        elapsed = time.perf_counter() - start
+
+    os.chdir('..')
+    shutil.rmtree(work_dir)
+
+    return {'stage': stage, 'seconds': elapsed, 'rows': rows, 'rows_per_second': rows / max(elapsed, 1e-9),
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'import_rss_mb': rss_before / 1024.0}
+
+
+def run_stage_subprocess(stage, data_dir):
+    """ run_stage in a fresh interpreter, so peak RSS belongs to this stage only """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    work_dir = os.path.abspath(data_dir.rstrip('/') + '-work')
+    env = dict(os.environ, PYTHONPATH=here + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-stage', stage,
+                                      '--data', os.path.abspath(data_dir), '--work', work_dir], env=env)
+
+    return ujson.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def time_startup(module, repeat=5):
+    """ Best-of-repeat seconds to import module in a fresh interpreter, and the heavy modules it loaded """
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = ('import sys, ujson\n'
+            'import {}\n'
+            'print(ujson.dumps([x for x in {} if x in sys.modules]))'.format(module, HEAVY_MODULES)) if module else 'pass'
+    best = float('inf')
+    loaded = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+        best = min(best, time.perf_counter() - start)
+        if module:
+            loaded = ujson.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    return best, loaded
+
+
+def check_startup():
+    """ Time every quick entry point; returns False if one of them regressed """
+
+    baseline, _ = time_startup(None)
+    print('{:<24} {:>8.3f} s'.format('(bare interpreter)', baseline))
+    ok = True
+    for module in STARTUP_MODULES:
+        seconds, loaded = time_startup(module)
+        over = seconds - baseline
+        status = 'OK'
+        if loaded or over > STARTUP_BUDGET:
+            status = 'SLOW' + (' (loads ' + ', '.join(loaded) + ')' if loaded else '')
+            ok = False
+        print('{:<24} {:>8.3f} s  +{:.3f} s  {}'.format(module, seconds, over, status))
+
+    return ok
+
+
+def git_revision():
+    """ Current commit, to tag results with """
+
+    try:
+        return subprocess.check_output(['git', '-C', os.path.dirname(os.path.abspath(__file__)),
+                                        'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare_results(old_file, new_file):
+    """ Print the per-stage change between two saved result files """
+
+    old = {x['stage']: x for x in ujson.load(open(old_file))['results']}
+    new = {x['stage']: x for x in ujson.load(open(new_file))['results']}
+    print('{:<10} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8}'.format('STAGE', 'OLD s', 'NEW s', 'RATIO',
+                                                                 'OLD MB', 'NEW MB', 'RATIO'))
+    for stage in [x for x in old if x in new]:
+        o, n = old[stage], new[stage]
+        print('{:<10} {:>12.3f} {:>12.3f} {:>8.2f} {:>12.1f} {:>12.1f} {:>8.2f}'.format(
+              stage, o['seconds'], n['seconds'], n['seconds'] / max(o['seconds'], 1e-9),
+              o['peak_rss_mb'], n['peak_rss_mb'], n['peak_rss_mb'] / max(o['peak_rss_mb'], 1e-9)))
+
+    return
+
+
+# MAIN
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark dedup, merge and import-building')
+    parser.add_argument('--size', default='small', help='small (10k), medium (1M), large (10M) or a row count')
+    parser.add_argument('--segments', type=int, default=20)
+    parser.add_argument('--overlap', type=float, default=0.3, help='Fraction of rows shared with other segments')
+    parser.add_argument('--stages', nargs='+', default=ALL_STAGES, choices=ALL_STAGES)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--keep-data', action='store_true', help='Reuse and keep the generated segments')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two result files')
+    parser.add_argument('--startup', action='store_true', help='Check import time of the quick entry points')
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--data', help=argparse.SUPPRESS)
+    parser.add_argument('--work', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+        sys.exit()
+
+    if args.startup:
+        sys.exit(0 if check_startup() else 1)
+
+    if args.run_stage:
+        result = run_stage(args.run_stage, args.data, args.work)
+        print(ujson.dumps(result))
+        sys.exit()
+
+    total_rows = SIZES[args.size] if args.size in SIZES else int(args.size)
+    data_dir = '{}/{}-{}-{}'.format(BENCHMARK_DATA_DIR, total_rows, args.segments, args.overlap)
+    if not (args.keep_data and os.path.isdir(data_dir)):
+        print('Generating', total_rows, 'rows in', args.segments, 'segments with overlap', args.overlap)
+        start = time.perf_counter()
+        generate_segments(total_rows, args.segments, args.overlap, data_dir)
+        print('Generated in {:.1f} s'.format(time.perf_counter() - start))
+
+    results = []
+    for stage in args.stages:
+        for r in range(args.repeat):
+            result = run_stage_subprocess(stage, data_dir)
+            result['repeat'] = r
+            results.append(result)
+            print('{:<8} {:>10.3f} s {:>14.0f} rows/s {:>10.1f} MB peak RSS'.format(
+                  stage, result['seconds'], result['rows_per_second'], result['peak_rss_mb']))
+
+    Path(BENCHMARK_RESULTS_DIR).mkdir(parents=True, exist_ok=True)
+    revision = git_revision()
+    results_file = '{}/{}-{}-{}.json'.format(BENCHMARK_RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S'), revision, total_rows)
+    with open(results_file, 'w') as fp:
+        ujson.dump({'revision': revision, 'rows': total_rows, 'segments': args.segments, 'overlap': args.overlap,
+                    'python': sys.version.split()[0], 'results': results}, fp, indent=4)
+    print('Results saved to', results_file)
+
+    if not args.keep_data:
+        shutil.rmtree(data_dir)
@@ -12,30 +12,44 @@ E-mail: prateek.goel@partsavatar.ca
 import os, sys, time
 from tqdm import tqdm
 import csv, ujson, hashlib
-import requests, io
+import io
 import zipfile, tarfile
 import socket
+import shutil
 import pandas as pd
 from pathlib import Path
-from subprocess import check_output
-from mailchimp3 import MailChimp
+import metrics
 from pprint import pprint
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
 FITMENT = False
+FITMENT_TIER = False
 MERGE_FITMENTS = False
 DE_DUPLICATION = True
+DUMP_MEMBERS_JSON = False
+DELETE_MEMBERS = False
+DELETE_FROM_CSV = True
+DELETE_LIST_ID = ''
+DELETE_CHUNK_SIZE = 10000
+DELETE_MAX_WORKERS = 4
+NEAR_DUPLICATES = False
+NEAR_DUP_DROP = False
+NEAR_DUP_WINDOW = 10
+NEAR_DUP_LNAME_PREFIX = 3
+NEAR_DUP_NAME_SIMILARITY = 0.85
+NEAR_DUP_CLUSTER_FILE = 'near_duplicate_clusters.csv'
 
 PWD = os.getcwd()
 PATH_SEGMENT = './All_segments'
 PATH_FITMENT = './All_fitments'
 PATH_DEDUP_SEG = './All_segments_deduplicated'
 
-# API key
-mc_api = " "
-
-# MailChimp client
-headers = requests.utils.default_headers()
-client = MailChimp(mc_api=mc_api, timeout=30.0, request_headers=headers)
+# MailChimp client, built on first use
+from mailchimp_client import client
+import metadata_cache
+import segment_io
+import segment_schema
 
 
 
@@ -57,10 +71,10 @@ def get_all_lists(f = "lists.name,lists.id"):
 
 
 def get_list_by_id(listid):
-    """ Returns the list matching provided id
+    """ Returns the list matching provided id (cached, see metadata_cache.py)
     """
 
-    list_matching = client.lists.get(listid)
+    list_matching = metadata_cache.get_json('lists/' + listid)
     list_matching_output = ujson.dumps(list_matching, indent=4)
 
     return list_matching, list_matching_output
@@ -70,6 +84,7 @@ def delete_list_by_id(listid):
     """ Delete an entire audience matching provided id."""
 
     client.lists.delete(listid)
+    metadata_cache.invalidate('lists/' + listid)
 
     return
 
@@ -113,34 +128,48 @@ def add_merge_fields_to_list(listid, merge_fields_to_create):
     return
 
 
-def create_members_list_batch(listid, csvfile):
-    """ Batch operation for creating multiple members at once from CSV file
+def read_members_from_csv(csvfile):
+    """ Generator over the members of a CSV file, one Mailchimp member body per row
     """
 
     primary_fields = ['email_address','status']
-    result = []
-    jsonfile = csvfile.split('.')[0]+'.json'
 
-    with open(csvfile, encoding='utf-8-sig') as csv_file:
+    with segment_io.open_segment(csvfile) as csv_file:
         reader = csv.DictReader(csv_file, skipinitialspace=True)
         for row in reader:
             d = {k: v for k, v in row.items() if k in primary_fields}
-
             d['merge_fields'] = {k: v for k, v in row.items() if k not in primary_fields}
-            result.append(d)  
-        with open(jsonfile, 'w')as fp:
-            ujson.dump(result, fp, indent=4)
+            yield d
 
 
-    with open(jsonfile, "r") as read_file:
+def build_member_operations(listid, csvfile, debug_dump=False):
+    """ Generator streaming CSV rows straight into serialized batch operations
 
-        data = ujson.load(read_file)
+    Every operation carries the member email as operation_id, so batch_errors.py
+    can map failures back to rows. With debug_dump, every member body is also
+    written (one per line) to a .jsonl file next to the CSV, for inspection only.
+    Nothing reads it back.
+    """
+
+    path = '/lists/' + listid + '/members'
+    dump = open(csvfile.split('.')[0]+'.jsonl', 'w') if debug_dump else None
+    try:
+        for member in read_members_from_csv(csvfile):
+            body = ujson.dumps(member)
+            if dump is not None:
+                dump.write(body + '\n')
+            yield {'method': 'POST', 'path': path, 'body': body,
+                   'operation_id': member['email_address']}
+    finally:
+        if dump is not None:
+            dump.close()
 
-        operations = [{
-            'method': 'POST',
-            'path': '/lists/' + listid + '/members',
-            'body': ujson.dumps(member)
-        } for member in data]
+
+def create_members_list_batch(listid, csvfile):
+    """ Batch operation for creating multiple members at once from CSV file
+    """
+
+    operations = list(build_member_operations(listid, csvfile, DUMP_MEMBERS_JSON))
 
     response = client.batch_operations.create(data={"operations": operations})
     BATCH_ID = response["id"]
@@ -179,28 +208,32 @@ def remove_full_duplicates(segment_1, segment_2, newfile):
     newfile: str
         Name of new file where new entries will be written
 
+    Returns the number of rows removed; newfile is only written if that is not zero.
     """
 
+    removed = 0
+
     # Note that the eqaulity check here only sees whether the two segments
     # are a copy of each other with SAME ORDERING!
     if segment_2.equals(segment_1):
         print('Provided segments are exactly the same,\
                no attempt made to find duplicates')
     else:
-        # Merge using 'outer'
+        # Merge using 'outer', on identical dtypes (categoricals then compare codes)
+        segment_schema.align_frames(segment_1, segment_2)
         seg2_unique = segment_1.merge(segment_2, how='outer', indicator=True).loc[lambda x : x['_merge']=='right_only']
 
         # Reset index and emove _merge column
         seg2_unique = seg2_unique.reset_index(drop=True)
         del seg2_unique['_merge']
 
-        # Write to file, csv file (use index=False)
-        # Can decide here how to write missign data
-        seg2_unique['YEAR'] = seg2_unique['YEAR'].fillna(9999)
-        seg2_unique['YEAR'] = seg2_unique['YEAR'].astype(int)
-        seg2_unique.to_csv(newfile, index=False)
+        # Write to file, csv file (use index=False), atomically
+        # YEAR is a nullable integer, missing years are written blank
+        removed = len(segment_2) - len(seg2_unique)
+        if removed:
+            segment_io.write_segment(seg2_unique, newfile)
 
-    return
+    return removed
 
 
 def assign_priority_segments_by_size(list_of_segments):
@@ -226,33 +259,342 @@ def assign_priority_segments_by_size(list_of_segments):
 
 
 def merge_segments_create_audience(all_segments_csv, filename):
-    """ Concatenate given dataframes to create one audience and write to file
+    """ Concatenate the given segment files into one file, streaming row by row
+    """
+
+    return segment_io.merge_segment_files(all_segments_csv, segment_io.segment_file(filename))
+
+
+def segment_path(segment, source_dir='.', output_dir='.'):
+    """ Latest version of a segment: its output file once written, otherwise the source file """
+
+    output = os.path.join(output_dir, segment)
+
+    return output if os.path.isfile(output) else os.path.join(source_dir, segment)
+
+
+def remove_duplicates_by_priority(all_segments_in_order, source_dir='.', output_dir='.'):
+    """ Remove from every segment the members of all higher priority segments
+
+    The first segment has the highest priority. Segments are read from source_dir
+    (or from output_dir once changed) and written to output_dir, each file
+    atomically and only if it loses rows. With the default arguments the files are
+    rewritten in place. Returns the number of input rows (every segment counted once).
     """
 
-    all_dataframes = [pd.read_csv(x, encoding='utf_8_sig') for x in all_segments_csv]
-    bigdataframe = pd.concat(all_dataframes)
-    bigdataframe.to_csv(filename, index=False)
+    n_segments = len(all_segments_in_order)
+    rows_in = {}
+    for i in range(n_segments - 1):
+        current_i_file = segment_io.read_segment(segment_path(all_segments_in_order[i], source_dir, output_dir))
+        rows_in.setdefault(i, len(current_i_file))
+        for j in range(i, n_segments):
+            if i != j:
+                current_j_file = segment_io.read_segment(segment_path(all_segments_in_order[j], source_dir, output_dir))
+                rows_in.setdefault(j, len(current_j_file))
+                write_to_file = os.path.join(output_dir, all_segments_in_order[j])
+                print('Checking segment', j+1, 'against', i+1)
+                print('Current segment file', all_segments_in_order[j])
+                remove_full_duplicates(current_i_file, current_j_file, write_to_file)
+            else:
+                pass
+
+    return sum(rows_in.values())
+
+
+def link_unchanged_segments(all_segments_in_order, source_dir, output_dir):
+    """ Hardlink the segments that lost no rows from source_dir into output_dir
+
+    Returns the number of segments linked (copied where hardlinks are not possible).
+    """
+
+    linked = 0
+    for segment in all_segments_in_order:
+        if not os.path.isfile(os.path.join(output_dir, segment)):
+            segment_io.link_or_copy(os.path.join(source_dir, segment), os.path.join(output_dir, segment))
+            linked += 1
+
+    return linked
+
+
+def replace_directory(new_dir, old_dir):
+    """ Move new_dir into the place of old_dir, removing the old contents """
+
+    if os.path.isdir(old_dir):
+        trash = old_dir.rstrip('/') + '.old'
+        if os.path.exists(trash):
+            shutil.rmtree(trash)
+        os.rename(old_dir, trash)
+        os.rename(new_dir, old_dir)
+        shutil.rmtree(trash)
+    else:
+        os.rename(new_dir, old_dir)
 
     return
 
 
+def normalize_name(name):
+    """ Lowercase letters and digits only, e.g. "O'Neil " -> 'oneil' """
+
+    return ''.join(ch for ch in name.lower() if ch.isalnum())
+
+
+def iter_near_duplicate_records(all_segments_in_order):
+    """ Generator over (ZIP, LNAME, FNAME, MAKE, MODEL, segment, row, email) of all rows, normalized
+
+    Rows without ZIP code or last name cannot be blocked and are left out.
+    """
+
+    for csvfile in all_segments_in_order:
+        with segment_io.open_segment(csvfile) as csv_file:
+            reader = csv.DictReader(csv_file, skipinitialspace=True)
+            for n, row in enumerate(reader):
+                zip_code = (row['ZIP_CODE'] or '').replace(' ', '').upper()
+                lname = normalize_name(row['LNAME'] or '')
+                if zip_code and lname:
+                    yield (zip_code, lname, normalize_name(row['FNAME'] or ''), normalize_name(row['MAKE'] or ''),
+                           normalize_name(row['MODEL'] or ''), csvfile, n, row['email_address'].strip().lower())
+
+
+def similar_names(a, b):
+    """ Equal, an initial of the other, or close enough (typos) """
+
+    from difflib import SequenceMatcher
+
+    if a == b:
+        return True
+    if not a or not b:
+        return False
+    if len(a) == 1 or len(b) == 1:
+        return a[0] == b[0]
+
+    return SequenceMatcher(None, a, b).ratio() >= NEAR_DUP_NAME_SIMILARITY
+
+
+def is_near_duplicate(r1, r2):
+    """ Same person and vehicle under a different email address """
+
+    return (r1[7] != r2[7] and r1[0] == r2[0] and r1[3] == r2[3] and r1[4] == r2[4]
+            and similar_names(r1[1], r2[1]) and similar_names(r1[2], r2[2]))
+
+
+def find_near_duplicates(all_segments_in_order, window=NEAR_DUP_WINDOW):
+    """ Clusters of rows that are the same person under different email addresses
+
+    Rows are blocked on ZIP code plus the first NEAR_DUP_LNAME_PREFIX letters of
+    the last name and sorted by name and vehicle within the block; each row is only
+    compared with the next window-1 rows of its block (sorted neighbourhood), so the
+    work grows linearly with the number of rows. Returns a list of clusters, each a
+    list of records (see iter_near_duplicate_records) in priority order.
+    """
+
+    records = list(iter_near_duplicate_records(all_segments_in_order))
+    records.sort(key=lambda r: (r[0], r[1][:NEAR_DUP_LNAME_PREFIX], r[1], r[2], r[3], r[4]))
+    parent = list(range(len(records)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    comparisons = 0
+    for i in range(len(records)):
+        block = (records[i][0], records[i][1][:NEAR_DUP_LNAME_PREFIX])
+        for j in range(i + 1, min(i + window, len(records))):
+            if (records[j][0], records[j][1][:NEAR_DUP_LNAME_PREFIX]) != block:
+                break
+            comparisons += 1
+            if is_near_duplicate(records[i], records[j]):
+                parent[find(j)] = find(i)
+
+    clusters = {}
+    for i in range(len(records)):
+        clusters.setdefault(find(i), []).append(records[i])
+    priority = {x: k for k, x in enumerate(all_segments_in_order)}
+    clusters = [sorted(x, key=lambda r: (priority[r[5]], r[6])) for x in clusters.values() if len(x) > 1]
+    print('Compared', comparisons, 'candidate pairs of', len(records), 'rows:', len(clusters), 'near-duplicate clusters')
+
+    return clusters
+
+
+def write_near_duplicate_clusters(clusters, filename=NEAR_DUP_CLUSTER_FILE):
+    """ One line per clustered row; keep=1 marks the row in the highest priority segment
+
+    `segment` and `row` (0-based, header excluded) locate the clustered row in its segment file.
+    """
+
+    with open(filename, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['cluster', 'email_address', 'segment', 'row', 'keep', 'FNAME', 'LNAME', 'ZIP_CODE',
+                         'MAKE', 'MODEL'])
+        for k, cluster in enumerate(clusters):
+            for n, r in enumerate(cluster):
+                writer.writerow([k, r[7], r[5], r[6], int(n == 0), r[2], r[1], r[0], r[3], r[4]])
+
+    return filename
+
+
+def drop_near_duplicates(all_segments_in_order, cluster_file=NEAR_DUP_CLUSTER_FILE):
+    """ Remove the rows marked keep=0 in the cluster file from the segments
+
+    Only the clustered rows themselves are removed (segment and row number), and
+    only while their email still matches; other rows of the same email, e.g. its
+    other vehicles, stay. Each segment is streamed to a temporary file which then
+    replaces it. Returns the number of rows removed.
+    """
+
+    drop = {}
+    with open(cluster_file, newline='') as fp:
+        for row in csv.DictReader(fp):
+            if row['keep'] == '0':
+                drop.setdefault(row['segment'], {})[int(row['row'])] = row['email_address'].strip().lower()
+
+    removed = 0
+    for csvfile in all_segments_in_order:
+        if csvfile not in drop:
+            continue
+        rows, number = drop[csvfile], [-1]
+
+        def clustered_row(row):
+            number[0] += 1
+            return rows.get(number[0]) == row['email_address'].strip().lower()
+
+        removed += filter_segment_file(csvfile, clustered_row)
+
+    return removed
+
+
+def filter_segment_file(csvfile, drop_row, output=None):
+    """ Stream a segment file without the rows for which drop_row(row) is true
+
+    The rows are written to a temporary file which then replaces output (default:
+    the segment itself), unless no row was dropped. Fields are read with
+    skipinitialspace. Returns the number of rows removed.
+    """
+
+    output = output or csvfile
+    removed = 0
+    tmp = segment_io.temp_segment_file(output)
+    with segment_io.open_segment(csvfile) as fin, segment_io.open_segment(tmp, 'w') as fout:
+        reader = csv.DictReader(fin, skipinitialspace=True)
+        writer = csv.DictWriter(fout, fieldnames=reader.fieldnames or [])
+        writer.writeheader()
+        for row in reader:
+            if drop_row(row):
+                removed += 1
+            else:
+                writer.writerow(row)
+    if removed:
+        os.replace(tmp, output)
+    else:
+        os.remove(tmp)
+
+    return removed
+
+
+def claim_fitment_keys(all_fitments_csv):
+    """ Keys (see segment_schema.row_keys) of all fitment rows, each fitment file read once
+
+    Fitments are the highest priority tier: any segment row equal to a fitment
+    row is dropped, like the members of a higher priority segment. Rows are read
+    as typed frames and so compared as in remove_full_duplicates.
+    """
+
+    claimed = set()
+    for csvfile in all_fitments_csv:
+        claimed.update(segment_schema.row_keys(segment_io.read_segment(csvfile)))
+    print(len(claimed), 'distinct fitment rows claimed')
+
+    return claimed
+
+
+def remove_claimed_rows(all_segments_in_order, claimed, source_dir='.', output_dir='.'):
+    """ Drop the rows already claimed by the fitment tier from every segment (see segment_path)
+
+    Segments are written to output_dir only if they lose rows. Returns the number of rows removed.
+    """
+
+    removed = 0
+    for segment in all_segments_in_order:
+        frame = segment_io.read_segment(segment_path(segment, source_dir, output_dir))
+        keep = [x not in claimed for x in segment_schema.row_keys(frame)]
+        if not all(keep):
+            segment_io.write_segment(frame[keep], os.path.join(output_dir, segment))
+            removed += len(keep) - sum(keep)
+
+    return removed
+
+
+def get_subscriber_hash(email_address):
+    """ MD5 hash of the lowercased email, the member id Mailchimp uses in URLs
+    """
+
+    return hashlib.md5(email_address.strip().lower().encode('utf-8')).hexdigest()
+
+
+def iter_subscribers_hash_csv(all_segments_csv):
+    """ Generator over the subscriber hashes of all members in the given CSV files
+
+    Computed locally from email_address, no API calls needed.
+    """
+
+    for csvfile in all_segments_csv:
+        with segment_io.open_segment(csvfile) as csv_file:
+            reader = csv.DictReader(csv_file, skipinitialspace=True)
+            for row in reader:
+                yield get_subscriber_hash(row['email_address'])
+
+
+def iter_subscribers_hash_list(listid, count=1000):
+    """ Generator over the subscriber hashes of a list, fetching only members.id page by page
+    """
+
+    offset = 0
+    while True:
+        response = client.lists.members.all(listid, status="subscribed", count=count, offset=offset,
+                                            fields="members.id")
+        page = response['members']
+        for member in page:
+            yield member['id']
+        if len(page) < count:
+            break
+        offset = offset + count
+
+
 def get_all_subscribers_hash(listid):
     """
     Batchify, as well! This function is crucial as the 
     hashes are needed for deleting members from an audience. 
     """
-    # Get all audience members. MD5 hash key is "id"
-    all_members, all_members_json = get_all_members_subscribed_list(listid)
-    n_members = len(all_members["members"])
-    print('There are', n_members, 'members in this Audience')
-    all_subscribers_hash = []
-    for i in range(n_members):
-        md5_hash_current = all_members["members"][i]["id"]
-        all_subscribers_hash.append(md5_hash_current)
+    # MD5 hash key is "id", only that field is downloaded
+    all_subscribers_hash = list(iter_subscribers_hash_list(listid))
+    print('There are', len(all_subscribers_hash), 'members in this Audience')
 
     return all_subscribers_hash
 
 
+def delete_members_list_chunked(listid, md5_hashes, chunk_size=DELETE_CHUNK_SIZE, max_workers=DELETE_MAX_WORKERS):
+    """ Delete members in batches of chunk_size, at most max_workers submissions at a time
+
+    md5_hashes can be any iterable (e.g. one of the generators above), it is
+    consumed one chunk at a time. Returns the list of batch ids.
+    """
+
+    md5_hashes = iter(md5_hashes)
+    chunks = iter(lambda: list(islice(md5_hashes, chunk_size)), [])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        all_batch_ids = []
+        pending = []
+        for chunk in chunks:
+            pending.append(executor.submit(delete_members_list_batch, listid, chunk))
+            if len(pending) >= max_workers:
+                all_batch_ids.append(pending.pop(0).result())
+        all_batch_ids.extend(x.result() for x in pending)
+
+    return all_batch_ids
+
+
 def get_all_members_list_batch(listid):
     """ Retrieve all members of a segment, identified by id"""
 
@@ -288,7 +630,7 @@ if __name__ == "__main__":
 
     # Segments and Fitments filenames
     segment_file = sys.argv[1]
-    #fitment_file = sys.argv[2]
+    fitment_file = sys.argv[2] if len(sys.argv) > 2 else None
 
     # Read from file
     merge_fields_pass = ['FNAME', 'LNAME', 'PROVINCE', 'CITY', 'ZIP_CODE', 'MAKE', 'MODEL', 'YEAR']
@@ -305,8 +647,8 @@ if __name__ == "__main__":
             all_segments_id.append(lines['Segment id'])
 
 
-    # CSV name lists for segments and fitments
-    all_segments_csv = [xxx + '.csv' for xxx in all_segments_name]
+    # CSV name lists for segments and fitments (plain or compressed, whichever was exported)
+    all_segments_csv = [segment_io.find_segment_file(xxx + '.csv', PATH_SEGMENT) or xxx + '.csv' for xxx in all_segments_name]
 
     if FITMENT:
         # Get fitment info
@@ -318,58 +660,86 @@ if __name__ == "__main__":
                 all_fitments_name.append(lines['Fitment Name'])
                 all_fitments_id.append(lines['Fitment id'])
 
-        all_fitments_csv = [xxx + '.csv' for xxx in all_fitments_name]
+        all_fitments_csv = [segment_io.find_segment_file(xxx + '.csv', PATH_FITMENT) or xxx + '.csv' for xxx in all_fitments_name]
+    else:
+        pass
+
+    # Delete members of a (test) audience, in bounded chunks
+    if DELETE_MEMBERS:
+        if DELETE_FROM_CSV:
+            # Hashes computed locally from the deduplicated segments, whichever codec they were written with
+            dedup_segments_csv = [os.path.join(PATH_DEDUP_SEG, segment_io.find_segment_file(xxx + '.csv', PATH_DEDUP_SEG) or xxx + '.csv')
+                                  for xxx in all_segments_name]
+            md5_hashes = iter_subscribers_hash_csv(dedup_segments_csv)
+        else:
+            # Collect the ids before deleting, deletes would shift the paging offsets
+            md5_hashes = get_all_subscribers_hash(DELETE_LIST_ID)
+        delete_batch_ids = delete_members_list_chunked(DELETE_LIST_ID, md5_hashes)
+        print('Delete batch operation ids:')
+        pprint(delete_batch_ids)
     else:
         pass
 
-    # Merge all fitments to create full fitment file!
+    # Merge all fitments to create full fitment file, only when the file itself is wanted;
+    # the dedup reads the fitment files directly (FITMENT_TIER)
     if MERGE_FITMENTS:
-    # Concatenate all fitment - create a large file
-    # This becomes priority 1 segment before deduplication
         os.chdir(PATH_FITMENT)
-        big_fitment = 'all_fitments_merged.csv'
-        merge_segments_create_audience(all_fitments_csv, big_fitment)
-        # Copy to segment directory
+        big_fitment = merge_segments_create_audience(all_fitments_csv, 'all_fitments_merged.csv')
+        print('Merged fitments written to', os.path.join(PATH_FITMENT, big_fitment))
         os.chdir(PWD)
-        os.system('cp ' + PATH_FITMENT + '/all_fitments_merged.csv ' + PATH_SEGMENT + '/.')
     else:
         pass
 
     # Deduplication
     if DE_DUPLICATION:
-        # Create deduplication directory
-        Path(PATH_DEDUP_SEG).mkdir(parents=True, exist_ok=True)
-
-        # Copy files from segments directory to the deduplication directory
-        check_output('cp ' + PATH_SEGMENT + '/*.csv ' +  PATH_DEDUP_SEG + '/.', shell=True)
-
-        # Move to deup directory
-        os.chdir(PATH_DEDUP_SEG)
-
-        # Assign priority 
+        # Segments are read from PATH_SEGMENT and never changed; results go to a fresh
+        # staging directory that replaces PATH_DEDUP_SEG only once everything is done
+        staging_dir = PATH_DEDUP_SEG.rstrip('/') + '.tmp'
+        if os.path.isdir(staging_dir):
+            shutil.rmtree(staging_dir)
+        Path(staging_dir).mkdir(parents=True)
+
+        # Assign priority
+        os.chdir(PATH_SEGMENT)
         all_segments_in_order = assign_priority_segments_by_size(all_segments_csv)
-
-        # Add big fitment file to first position
-        # FEB 13: Commenting out for now, no need for fitments
-        # all_segments_in_order.insert(0, 'all_fitments_merged.csv')
+        os.chdir(PWD)
 
         print('All segments by size in descending order')
         pprint(all_segments_in_order)
 
-        n_segments = len(all_segments_in_order)
+        # Fitments come first: drop every segment row that is in a fitment
+        if FITMENT and FITMENT_TIER:
+            with metrics.stage('fitment_tier') as stage_info:
+                claimed = claim_fitment_keys([os.path.join(PATH_FITMENT, x) for x in all_fitments_csv])
+                stage_info['rows'] = remove_claimed_rows(all_segments_in_order, claimed, PATH_SEGMENT, staging_dir)
+            print('Removed', stage_info['rows'], 'segment rows already in fitments')
+            del claimed
+
         # Remove Duplicates from Segments
-        for i in range(n_segments - 1):
-            current_i_file = pd.read_csv(all_segments_in_order[i]) 
-            for j in range(i, n_segments):
-                if i != j:
-                    current_j_file = pd.read_csv(all_segments_in_order[j]) 
-                    write_to_file = all_segments_in_order[j]
-                    print('Checking segment', j+1, 'against', i+1)
-                    print('Current segment file', all_segments_in_order[j])
-                    remove_full_duplicates(current_i_file, current_j_file, write_to_file)
-                else:
-                    pass
+        with metrics.stage('deduplication') as stage_info:
+            stage_info['rows'] = remove_duplicates_by_priority(all_segments_in_order, PATH_SEGMENT, staging_dir)
+
+        # Segments that lost nothing are hardlinked, not copied
+        linked = link_unchanged_segments(all_segments_in_order, PATH_SEGMENT, staging_dir)
+        print(len(all_segments_in_order) - linked, 'segments rewritten,', linked, 'unchanged and linked')
+
+        # Move to dedup staging directory
+        os.chdir(staging_dir)
+
+        # Same person under different email addresses, optional
+        if NEAR_DUPLICATES:
+            with metrics.stage('near_duplicates') as stage_info:
+                clusters = find_near_duplicates(all_segments_in_order)
+                write_near_duplicate_clusters(clusters, os.path.join(PWD, NEAR_DUP_CLUSTER_FILE))
+                stage_info['rows'] = sum(len(x) for x in clusters)
+            print('Near-duplicate clusters written to', NEAR_DUP_CLUSTER_FILE)
+            if NEAR_DUP_DROP:
+                removed = drop_near_duplicates(all_segments_in_order, os.path.join(PWD, NEAR_DUP_CLUSTER_FILE))
+                print('Removed', removed, 'near-duplicate members')
         os.chdir(PWD)
+
+        # Publish the complete result
+        replace_directory(staging_dir, PATH_DEDUP_SEG)
     else:
         pass
 
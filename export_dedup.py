@@ -0,0 +1,169 @@
+"""
+Priority dedup while exporting, so segments are ready for import as they download
+
+With `python3 export_segments.py --plan export_plan.json --dedup` every segment
+is written straight to All_segments_deduplicated, without the rows a higher
+priority segment already has. This replaces the plain priority dedup of
+deduplication.py only: the fitment tier and the near-duplicate search are not
+applied, and rows are compared as exported strings (segment_io.row_key), where
+deduplication.py compares typed frames.
+
+Pages are still fetched in parallel, but segments are committed strictly in
+priority order (most members first, the order deduplication.py uses by file
+size): once a segment and all segments before it have every page on disk, its
+parts are streamed through the set of row keys claimed so far, the new rows are
+written and their keys claimed. The segments are queued in the same order, so
+commits follow the download closely.
+
+Segments are identified by (list id, segment id), as in export_segments.py, and
+written under the same file names as their raw segment files, so plans of
+several lists may use the same segment name.
+
+A segment that fails holds back the commits after it. At the end of the run the
+parts of those segments are merged into their raw segment files, so the next run
+only filters them. Segments already in the output directory are read once at
+start to claim their keys, and segments whose raw CSV exists are not fetched
+again.
+
+"""
+
+import os, csv, time
+import threading
+import metrics
+import segment_io
+
+PATH_DEDUP_SEG = './All_segments_deduplicated'
+
+
+def priority_order(segments):
+    """ Segments sorted by priority: most members first, plan order among equals """
+
+    return sorted(segments, key=lambda x: -x['members'])
+
+
+class StreamingDedup(object):
+    """ Commits exported segments in priority order through a shared set of claimed rows
+
+        dedup = StreamingDedup([(listid, segmentid), ...], names, output_dir)
+        ...
+        dedup.segment_done(key, parts, raw_file)     # from any thread, in any order
+        ...
+        dedup.keep_raw()                             # after a failure
+    """
+
+    def __init__(self, order, names, output_dir=PATH_DEDUP_SEG):
+        self.order = list(order)
+        self.names = names
+        self.output_dir = os.path.abspath(output_dir)
+        self.claimed = set()
+        self.ready = {}
+        self.committed = set()
+        self.next = 0
+        self.committing = False
+        self._lock = threading.Lock()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        for key in self.order:
+            found = segment_io.find_segment_file(self.output_name(key), self.output_dir)
+            if found:
+                self.claim_file(os.path.join(self.output_dir, found))
+                self.committed.add(key)
+        if self.committed:
+            print(len(self.committed), 'segments already deduplicated,', len(self.claimed), 'rows claimed')
+
+    def claim_file(self, filename):
+        """ Claim the rows of a segment file committed by an earlier run """
+
+        with segment_io.open_segment(filename) as fp:
+            for row in csv.DictReader(fp):
+                self.claimed.add(segment_io.row_key(row))
+
+        return
+
+    def output_name(self, key):
+        """ File name of a deduplicated segment, the same as its raw file (export_segments.segment_file_names) """
+
+        return self.names[key] + '.csv'
+
+    def segment_done(self, key, parts, raw_file, remove_parts=True):
+        """ All parts of a segment are on disk; commit it and whatever it was holding back
+
+        raw_file is where keep_raw() merges the parts if the segment cannot be committed.
+        The thread that finds nothing else committing does the commits, others return at once.
+        """
+
+        with self._lock:
+            self.ready[key] = (parts, raw_file, remove_parts)
+            if self.committing:
+                return
+            self.committing = True
+
+        while True:
+            with self._lock:
+                while self.next < len(self.order) and self.order[self.next] in self.committed:
+                    self.next += 1
+                if self.next == len(self.order) or self.order[self.next] not in self.ready:
+                    self.committing = False
+                    return
+                key = self.order[self.next]
+                entry = self.ready.pop(key)
+            try:
+                self.commit(key, entry[0], entry[2])
+            except Exception as e:
+                print('FAILED: deduplicating segment', self.names[key], '-', repr(e))
+                with self._lock:
+                    self.ready[key] = entry
+                    self.committing = False
+                return
+            with self._lock:
+                self.committed.add(key)
+
+    def commit(self, key, parts, remove_parts):
+        """ Write the rows of a segment that no higher priority segment has, then claim them """
+
+        start = time.perf_counter()
+        keys = set()
+        counts = {'kept': 0, 'dropped': 0}
+
+        def keep_row(row):
+            row_key = segment_io.row_key(row)
+            if row_key in self.claimed:
+                counts['dropped'] += 1
+                return False
+            keys.add(row_key)
+            counts['kept'] += 1
+            return True
+
+        output = segment_io.segment_file(os.path.join(self.output_dir, self.output_name(key)))
+        segment_io.merge_segment_files(parts, output, keep_row)
+        self.claimed |= keys
+        if remove_parts:
+            for x in parts:
+                os.remove(x)
+        print('Deduplicated segment', self.names[key], '-', counts['kept'], 'rows kept,', counts['dropped'], 'dropped')
+        metrics.record_stage('dedup_segment', time.perf_counter() - start, counts['kept'] + counts['dropped'])
+
+        return
+
+    def keep_raw(self):
+        """ Merge the parts of segments held back by a failure into their raw files; returns how many
+
+        The next run then only filters them instead of downloading them again.
+        """
+
+        with self._lock:
+            held_back = [(key, self.ready.pop(key)) for key in list(self.ready) if key not in self.committed]
+        for key, (parts, raw_file, remove_parts) in held_back:
+            if not remove_parts:
+                continue            # parts are the raw file already
+            segment_io.merge_segment_files(parts, segment_io.segment_file(raw_file))
+            for x in parts:
+                os.remove(x)
+            print('Kept raw export of', self.names[key], 'in', raw_file, '- it is deduplicated by the next run')
+
+        return len(held_back)
+
+    def waiting(self):
+        """ Names of the segments not committed, in priority order """
+
+        return [self.names[key] for key in self.order if key not in self.committed]
@@ -15,19 +15,15 @@ import csv, ujson, hashlib
 import requests, io
 import zipfile, tarfile
 import logging, socket
-import pandas as pd
 from pathlib import Path
-from mailchimp3 import MailChimp
 
 EXPORT_SEGMENTS = False
 EXPORT_FITMENTS = False
 
-# API key
-mc_api = " "
-
-# MailChimp client
-headers = requests.utils.default_headers()
-client = MailChimp(mc_api=mc_api, timeout=30.0, request_headers=headers)
+# MailChimp client, built on first use
+from mailchimp_client import client
+import metadata_cache
+import segment_io
 
 # List id
 PARTSAVATAR_CUSTOMERS_LIST_ID = "8adfbf295d"     # PartsAvatar Customers
@@ -50,10 +46,10 @@ def get_all_lists(f = "lists.name,lists.id"):
 
 
 def get_list_by_id(listid):
-    """ Returns the list matching provided id
+    """ Returns the list matching provided id (cached, see metadata_cache.py)
     """
 
-    list_matching = client.lists.get(listid)
+    list_matching = metadata_cache.get_json('lists/' + listid)
     list_matching_output = ujson.dumps(list_matching, indent=4)
 
     return list_matching, list_matching_output
@@ -73,9 +69,12 @@ def get_all_segments(listid):
 
 
 def get_info_segment(listid, segmentid):
-    """ Get information on a particular segment by id"""
+    """ Get information on a particular segment by id
+
+    Always revalidated (see metadata_cache.py): member_count sets how many pages are exported.
+    """
 
-    response = client.lists.segments.get(listid, segmentid)
+    response = metadata_cache.get_json('lists/' + listid + '/segments/' + str(segmentid), revalidate=True)
     segment_name = response['name']
     segment_member_count = response['member_count']
 
@@ -129,8 +128,7 @@ def get_segment_members(listid, segmentid, merge_fields, count, offset, counter,
 
             # Convert to csv
             temp_name_csv = "".join(seg_name.split()) + '-part-' + str(counter)
-            all_parts_csv.append(temp_name_csv + '.csv')
-            write_dict_to_csv(current_segment_dict, temp_name_csv, merge_fields)
+            all_parts_csv.append(write_dict_to_csv(current_segment_dict, temp_name_csv, merge_fields))
             offset = offset + count
             counter = counter + 1
             time.sleep(60)
@@ -189,10 +187,10 @@ def write_dict_to_csv(newdict_segment, file_prefix, merge_fields):
     # This also defines the headers of csv file basically
     all_fields = primary_fields + merge_fields
 
-    # Write to CSV
-    csv_file = file_prefix + ".csv"
+    # Write to CSV (compressed when MAILCHIMP_SEGMENT_COMPRESSION is set)
+    csv_file = segment_io.segment_file(file_prefix + ".csv")
     try:
-        with open(csv_file,'w',encoding='utf-8-sig',newline='') as csvfile:
+        with segment_io.open_segment(csv_file, 'w') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=all_fields)
             writer.writeheader()
             for data in newdict_segment:
@@ -205,14 +203,10 @@ def write_dict_to_csv(newdict_segment, file_prefix, merge_fields):
 
 
 def merge_segments_create_audience(all_segments_csv, filename):
-    """ Concatenate given dataframes to create one audience and write to file
+    """ Concatenate the part files of a segment into one file, streaming row by row
     """
 
-    all_dataframes = [pd.read_csv(x, encoding='utf_8_sig') for x in all_segments_csv]
-    bigdataframe = pd.concat(all_dataframes)
-    bigdataframe.to_csv(filename, index=False)
-
-    return
+    return segment_io.merge_segment_files(all_segments_csv, segment_io.segment_file(filename))
 
 
 def get_all_members_segment_batch(listid, segmentid):
@@ -297,19 +291,20 @@ def get_segment_from_json_to_csv(segment_name):
 
     os.chdir('..')
 
-    f = csv.writer(open(segment_name+".csv", "w+"))
-    f.writerow(headers)
-    for member in all_members:
-        f.writerow([member['email_address'], 
-                    member['status'], 
-                    member['merge_fields']['FNAME'],
-                    member['merge_fields']['LNAME'],
-                    member['merge_fields']['PROVINCE'],
-                    member['merge_fields']['CITY'],
-                    member['merge_fields']['ZIP_CODE'],
-                    member['merge_fields']['MAKE'],
-                    member['merge_fields']['MODEL'],
-                    member['merge_fields']['YEAR']])
+    with segment_io.write_segment_atomic(segment_io.segment_file(segment_name + ".csv")) as fp:
+        f = csv.writer(fp)
+        f.writerow(headers)
+        for member in all_members:
+            f.writerow([member['email_address'],
+                        member['status'],
+                        member['merge_fields']['FNAME'],
+                        member['merge_fields']['LNAME'],
+                        member['merge_fields']['PROVINCE'],
+                        member['merge_fields']['CITY'],
+                        member['merge_fields']['ZIP_CODE'],
+                        member['merge_fields']['MAKE'],
+                        member['merge_fields']['MODEL'],
+                        member['merge_fields']['YEAR']])
 
     return
 
@@ -0,0 +1,368 @@
+"""
+Durable queue of segment export pages, shared by worker processes and hosts
+
+Usage:
+    python3 export_queue.py fill export_plan.json [--queue export_queue]
+    python3 export_queue.py work [--queue export_queue] [--threads 4] [--rate 5]
+    python3 export_queue.py status [--queue export_queue]
+
+`fill` turns an export plan (prepare_input_export.py) into one job per page.
+Any number of `work` processes, on this host or on others that mount the same
+directory, then claim jobs, fetch the pages and write the part files; whoever
+finishes the last page of a segment merges its parts into the segment file.
+
+The queue is a directory of small JSON files, one per job, moved between
+
+    pending/  ->  leased/  ->  done/      (or failed/ after MAX_ATTEMPTS)
+
+with os.rename, which is atomic also on network filesystems, so a job is leased
+by exactly one worker. The leased file name carries the worker and the lease
+time, and the worker touches the files of its leases every HEARTBEAT_SECONDS;
+leases neither taken nor touched for LEASE_SECONDS (a crashed or stuck worker)
+are moved back to pending by any other worker. Filling is idempotent
+and a killed run is resumed by starting workers again.
+
+Each worker process has its own request budget (--threads, --rate); with several
+workers the API limits are shared between them.
+
+"""
+
+import os, sys, time
+import ujson
+import socket
+import argparse
+import threading
+
+JOB_QUEUE_DIR = './export_queue'
+LEASE_SECONDS = 120
+HEARTBEAT_SECONDS = 20
+MAX_ATTEMPTS = 5
+IDLE_WAIT = 5
+STATES = ['pending', 'leased', 'done', 'failed']
+
+
+def job_name(listid, segmentid, part):
+    """ File name of a job, sorting by segment and page """
+
+    return '{}-{}-{:06d}.json'.format(listid, segmentid, part)
+
+
+def write_json_atomic(filename, value):
+    """ Write a JSON file through a temporary file and a rename """
+
+    tmp = '{}.tmp-{}-{}'.format(filename, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as fp:
+        ujson.dump(value, fp)
+    os.replace(tmp, filename)
+
+    return
+
+
+def fill_queue(plan_file, queue_dir=JOB_QUEUE_DIR):
+    """ Add one job per page of every segment in the plan; existing jobs are left alone
+
+    Segment directories are stored relative to the parent of the queue directory,
+    so hosts that mount the project at different paths resolve them alike.
+    Returns the number of jobs added.
+    """
+
+    for state in STATES:
+        os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+    with open(plan_file) as fp:
+        plan = ujson.load(fp)
+    root = os.path.dirname(os.path.abspath(queue_dir))
+    directory = os.path.relpath(os.path.abspath(plan['directory']), root)
+    existing = set(x.split('@')[0] for state in STATES for x in os.listdir(os.path.join(queue_dir, state)))
+
+    import segment_io
+    import export_segments
+
+    names = export_segments.segment_file_names([plan])
+    added = 0
+    for segment in plan['segments']:
+        listid = segment.get('list_id', plan['list_id'])
+        file_name = names[(listid, segment['id'])]
+        if segment_io.find_segment_file(file_name + '.csv', plan['directory']):
+            continue                # exported already
+        offsets = list(range(0, segment['members'], segment['count']))
+        for k, offset in enumerate(offsets):
+            name = job_name(listid, segment['id'], k + 1)
+            if name in existing:
+                continue
+            job = {'list_id': listid, 'segment_id': segment['id'], 'segment_name': segment['name'],
+                   'file_name': file_name, 'count': segment['count'], 'offset': offset, 'part': k + 1, 'parts': len(offsets),
+                   'directory': directory, 'merge_fields': plan['merge_fields'], 'attempts': 0}
+            write_json_atomic(os.path.join(queue_dir, 'pending', name), job)
+            added += 1
+
+    return added
+
+
+def claim_job(queue_dir, worker_id):
+    """ Lease the first pending job; returns (leased file, job) or None when there is none
+
+    The leased name is <job>@<worker>@<lease time>: the rename keeps the old
+    modification time of the pending file, so staleness must not rely on it alone.
+    """
+
+    for name in sorted(os.listdir(os.path.join(queue_dir, 'pending'))):
+        if not name.endswith('.json'):
+            continue
+        leased = os.path.join(queue_dir, 'leased', '{}@{}@{:.3f}'.format(name, worker_id, time.time()))
+        try:
+            os.rename(os.path.join(queue_dir, 'pending', name), leased)
+            os.utime(leased, None)
+            with open(leased) as fp:
+                return leased, ujson.load(fp)
+        except FileNotFoundError:
+            continue                # someone else was faster, or the lease was reclaimed meanwhile
+
+    return None
+
+
+def lease_time(name):
+    """ Time a leased file was taken, from its name (0 if it has none) """
+
+    try:
+        return float(name.rsplit('@', 1)[1])
+    except (IndexError, ValueError):
+        return 0.0
+
+
+def reclaim_stale_leases(queue_dir, lease_seconds=LEASE_SECONDS):
+    """ Move leases neither taken nor touched for lease_seconds back to pending; returns how many """
+
+    reclaimed = 0
+    leased_dir = os.path.join(queue_dir, 'leased')
+    now = time.time()
+    for name in os.listdir(leased_dir):
+        path = os.path.join(leased_dir, name)
+        try:
+            if now - max(os.stat(path).st_mtime, lease_time(name)) < lease_seconds:
+                continue
+            os.rename(path, os.path.join(queue_dir, 'pending', name.split('@')[0]))
+        except FileNotFoundError:
+            continue                # finished or reclaimed meanwhile
+        print('Reclaimed stale lease', name)
+        reclaimed += 1
+
+    return reclaimed
+
+
+def finish_job(queue_dir, leased, job, error=None):
+    """ Move a leased job to done, or back to pending (failed/ after MAX_ATTEMPTS) on error
+
+    Returns False if the lease was lost meanwhile (reclaimed as stale).
+    """
+
+    name = os.path.basename(leased).split('@')[0]
+    if not os.path.exists(leased):
+        return False
+    if error is None:
+        target = os.path.join(queue_dir, 'done', name)
+    else:
+        job = dict(job, attempts=job['attempts'] + 1, error=repr(error))
+        state = 'failed' if job['attempts'] >= MAX_ATTEMPTS else 'pending'
+        target = os.path.join(queue_dir, state, name)
+        write_json_atomic(leased, job)
+    try:
+        os.rename(leased, target)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def segment_parts_done(queue_dir, job):
+    """ True when every page job of the segment of job is in done/ """
+
+    prefix = '{}-{}-'.format(job['list_id'], job['segment_id'])
+    done = [x for x in os.listdir(os.path.join(queue_dir, 'done')) if x.startswith(prefix) and x.endswith('.json')]
+
+    return len(done) == job['parts']
+
+
+def merge_finished_segments(queue_dir, root):
+    """ Merge every segment whose pages are all done but whose file is missing (e.g. its merger died) """
+
+    done_dir = os.path.join(queue_dir, 'done')
+    first_jobs = {}
+    for name in sorted(os.listdir(done_dir)):
+        if name.endswith('.json'):
+            first_jobs.setdefault(name.rsplit('-', 1)[0], name)
+
+    merged = 0
+    for name in first_jobs.values():
+        with open(os.path.join(done_dir, name)) as fp:
+            job = ujson.load(fp)
+        if segment_parts_done(queue_dir, job):
+            merged += merge_segment(queue_dir, job, os.path.join(root, job['directory']))
+
+    return merged
+
+
+def part_prefix(directory, job, part):
+    """ Part file prefix of one page, <list id>-<segment id>-part-<k> as in export_segments.py """
+
+    import export_segments
+
+    return export_segments.part_file_prefix(directory, (job['list_id'], job['segment_id']), part)
+
+
+def merge_segment(queue_dir, job, directory):
+    """ Merge the parts of a finished segment, once: the merger creates a marker file first
+
+    A marker older than LEASE_SECONDS (the merger died) is taken over by renaming it
+    away, which only one worker wins. Should the old merger still be alive, the parts
+    are gone or the segment file exists already for one of them, which then stops.
+    Returns True if merged here.
+    """
+
+    import export_segments
+    import segment_io
+
+    target = os.path.join(directory, job['file_name'] + '.csv')
+    if segment_io.find_segment_file(target):
+        return False
+    marker = os.path.join(queue_dir, 'done', '{}-{}.merging'.format(job['list_id'], job['segment_id']))
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        stale = '{}.stale-{}-{}-{}'.format(marker, socket.gethostname(), os.getpid(), threading.get_ident())
+        try:
+            if time.time() - os.stat(marker).st_mtime < LEASE_SECONDS:
+                return False
+            os.rename(marker, stale)
+        except FileNotFoundError:
+            return False            # someone else merged, or took the marker over
+        os.remove(stale)
+        print('Taking over the merge of segment', job['segment_id'], job['segment_name'])
+        return merge_segment(queue_dir, job, directory)
+
+    parts = [segment_io.segment_file(part_prefix(directory, job, k) + '.csv') for k in range(1, job['parts'] + 1)]
+    try:
+        export_segments.merge_segments_create_audience(parts, target)
+        for x in parts:
+            os.remove(x)
+    except FileNotFoundError:
+        return False                # a merger that took over has finished already
+    try:
+        os.remove(marker)
+    except FileNotFoundError:
+        pass
+    print('SUCCESS! Exported segment', job['segment_id'], job['segment_name'])
+
+    return True
+
+
+def run_job(job, directory, limiter):
+    """ Fetch one page and write its part file """
+
+    import export_segments
+
+    limiter.acquire()
+    response = export_segments.get_segment_page(job['list_id'], job['segment_id'], job['count'], job['offset'])
+    current_segment_dict = export_segments.create_segment_to_dict(response, job['merge_fields'], len(response['members']))
+    export_segments.write_dict_to_csv(current_segment_dict, part_prefix(directory, job, job['part']), job['merge_fields'])
+
+    return
+
+
+def run_worker(queue_dir=JOB_QUEUE_DIR, threads=4, rate=5):
+    """ Work on the queue until no job is pending or leased anywhere; returns jobs done here """
+
+    from export_scheduler import RateLimiter
+
+    worker_id = '{}-{}'.format(socket.gethostname(), os.getpid())
+    root = os.path.dirname(os.path.abspath(queue_dir))
+    limiter = RateLimiter(rate, burst=threads)
+    leases = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+    done_here = [0]
+
+    def heartbeat():
+        while not stop.wait(HEARTBEAT_SECONDS):
+            with lock:
+                current = list(leases)
+            for leased in current:
+                try:
+                    os.utime(leased, None)
+                except FileNotFoundError:
+                    pass
+
+    def work():
+        while True:
+            claimed = claim_job(queue_dir, worker_id)
+            if claimed is None:
+                reclaim_stale_leases(queue_dir)
+                if not os.listdir(os.path.join(queue_dir, 'pending')) and not os.listdir(os.path.join(queue_dir, 'leased')):
+                    return
+                time.sleep(IDLE_WAIT)
+                continue
+            leased, job = claimed
+            directory = os.path.join(root, job['directory'])
+            with lock:
+                leases.add(leased)
+            try:
+                run_job(job, directory, limiter)
+                error = None
+            except Exception as e:
+                print('Job', os.path.basename(leased), 'failed:', repr(e))
+                error = e
+            with lock:
+                leases.discard(leased)
+            if not finish_job(queue_dir, leased, job, error):
+                print('Lost the lease of', os.path.basename(leased), '- result discarded by the queue')
+                continue
+            if error is None:
+                with lock:
+                    done_here[0] += 1
+                if segment_parts_done(queue_dir, job):
+                    merge_segment(queue_dir, job, directory)
+
+    beat = threading.Thread(target=heartbeat, daemon=True)
+    beat.start()
+    workers = [threading.Thread(target=work) for _ in range(max(1, threads))]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    stop.set()
+    merge_finished_segments(queue_dir, root)
+
+    return done_here[0]
+
+
+def queue_status(queue_dir=JOB_QUEUE_DIR):
+    """ Number of jobs per state """
+
+    return {state: len([x for x in os.listdir(os.path.join(queue_dir, state)) if '.json' in x and '.tmp' not in x])
+            for state in STATES}
+
+
+# MAIN
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Durable queue of segment export pages')
+    parser.add_argument('command', choices=['fill', 'work', 'status'])
+    parser.add_argument('plan', nargs='?', help='export plan (fill)')
+    parser.add_argument('--queue', default=JOB_QUEUE_DIR, help='queue directory')
+    parser.add_argument('--threads', type=int, default=4, help='parallel jobs in this worker')
+    parser.add_argument('--rate', type=float, default=5, help='requests per second of this worker (0 = unlimited)')
+    args = parser.parse_args()
+
+    if args.command == 'fill':
+        if not args.plan:
+            parser.error('fill needs an export plan')
+        print('Added', fill_queue(args.plan, args.queue), 'jobs to', args.queue)
+    elif args.command == 'work':
+        import metrics
+        with metrics.stage('export_queue_worker') as stage_info:
+            stage_info['rows'] = run_worker(args.queue, args.threads, args.rate)
+        print('Worker finished', stage_info['rows'], 'jobs')
+
+    status = queue_status(args.queue)
+    print(' '.join('{}: {}'.format(k, v) for k, v in status.items()))
+    if args.command == 'work' and status['failed']:
+        sys.exit(1)
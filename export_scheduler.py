@@ -0,0 +1,139 @@
+"""
+Shared concurrency and rate budget for API requests from several lists
+
+All page requests of an export run go through one FairScheduler:
+
+    - at most `max_workers` requests are in flight at any time
+    - at most `rate` requests are started per second (token bucket, 0 disables)
+    - jobs are queued per tenant (the list id) and tenants are served round
+      robin, so a list with many large segments cannot starve the others
+
+Jobs of one tenant run in the order they were submitted (retries can be put at
+the front). The total throughput is thereby set by the API limits, not by how
+many export processes happen to be running.
+
+"""
+
+import time
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+
+
+class RateLimiter(object):
+    """ Token bucket: acquire() blocks until a request may start """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class FairScheduler(object):
+    """ Worker threads running jobs from per-tenant queues, round robin, under a rate limit
+
+        with FairScheduler(max_workers=10, rate=5) as scheduler:
+            scheduler.submit(listid, function, *args)
+            ...
+        # leaving the block waits for all jobs, including ones submitted by jobs
+    """
+
+    def __init__(self, max_workers, rate=0):
+        self.limiter = RateLimiter(rate, burst=max_workers)
+        self.queues = OrderedDict()
+        self.unfinished = 0
+        self.closed = False
+        self._cond = threading.Condition()
+        self._threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, max_workers))]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, tenant, fn, *args, front=False):
+        """ Queue fn(*args) for tenant; returns a Future """
+
+        future = Future()
+        with self._cond:
+            queue = self.queues.setdefault(tenant, deque())
+            if front:
+                queue.appendleft((future, fn, args))
+            else:
+                queue.append((future, fn, args))
+            self.unfinished += 1
+            self._cond.notify()
+
+        return future
+
+    def _next_job(self):
+        """ Pop the next job of the next tenant with work, rotating tenants (lock held) """
+
+        for tenant in list(self.queues):
+            queue = self.queues[tenant]
+            self.queues.move_to_end(tenant)
+            if queue:
+                return queue.popleft()
+
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None and not self.closed:
+                    self._cond.wait()
+                    job = self._next_job()
+                if job is None:
+                    return
+            future, fn, args = job
+            if future.set_running_or_notify_cancel():
+                self.limiter.acquire()
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._cond:
+                self.unfinished -= 1
+                self._cond.notify_all()
+
+    def join(self):
+        """ Wait until every submitted job has finished """
+
+        with self._cond:
+            while self.unfinished:
+                self._cond.wait()
+
+        return
+
+    def shutdown(self):
+        """ Wait for all jobs, then stop the workers """
+
+        self.join()
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        return False
@@ -10,24 +10,36 @@ E-mail: prateek.goel@partsavatar.ca
 """
 
 import os, sys, time
-from tqdm import tqdm
 import csv, ujson, hashlib
-import requests, io
+import io
 import zipfile, tarfile
 import logging, socket
-import pandas as pd
+import threading
 from pathlib import Path
-from mailchimp3 import MailChimp
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 
+PWD = os.getcwd()
 EXPORT_SEGMENTS = True
 EXPORT_FITMENTS = False
 
-# API key
-mc_api = " "
+# Every page fetched is timed and recorded here, prepare_input_export.py plans page sizes from it
+EXPORT_HISTORY_FILE = os.path.abspath('export_history.jsonl')
+PAGE_RETRIES = 3
 
-# MailChimp client
-headers = requests.utils.default_headers()
-client = MailChimp(mc_api=mc_api, timeout=30.0, request_headers=headers)
+# Budget shared by all segments and lists of an export run (Mailchimp allows 10 connections at a time)
+MAX_CONCURRENT_REQUESTS = 8
+MAX_REQUESTS_PER_SECOND = 5
+
+# MailChimp client, built on first use
+from mailchimp_client import client
+import metadata_cache
+import response_cache
+import segment_io
+
+# Segment member pages may be replayed from disk (MAILCHIMP_RESPONSE_CACHE_DIR)
+response_cache.enable()
 
 # List id
 PARTSAVATAR_CUSTOMERS_LIST_ID = "8adfbf295d"     # PartsAvatar Customers
@@ -50,10 +62,10 @@ def get_all_lists(f = "lists.name,lists.id"):
 
 
 def get_list_by_id(listid):
-    """ Returns the list matching provided id
+    """ Returns the list matching provided id (cached, see metadata_cache.py)
     """
 
-    list_matching = client.lists.get(listid)
+    list_matching = metadata_cache.get_json('lists/' + listid)
     list_matching_output = ujson.dumps(list_matching, indent=4)
 
     return list_matching, list_matching_output
@@ -73,9 +85,12 @@ def get_all_segments(listid):
 
 
 def get_info_segment(listid, segmentid):
-    """ Get information on a particular segment by id"""
+    """ Get information on a particular segment by id
+
+    Always revalidated (see metadata_cache.py): member_count sets how many pages are exported.
+    """
 
-    response = client.lists.segments.get(listid, segmentid)
+    response = metadata_cache.get_json('lists/' + listid + '/segments/' + str(segmentid), revalidate=True)
     segment_name = response['name']
     segment_member_count = response['member_count']
 
@@ -99,6 +114,44 @@ def get_all_segment_members_direct(listid, segmentid, merge_fields):
     return
 
 
+_history_lock = threading.Lock()
+
+
+def is_timeout(error):
+    """ True for socket and requests timeouts """
+
+    return isinstance(error, socket.timeout) or 'Timeout' in type(error).__name__
+
+
+def get_segment_page(listid, segmentid, count, offset):
+    """ One page of segment members; duration and outcome are appended to EXPORT_HISTORY_FILE
+    """
+
+    start = time.time()
+    try:
+        response = client.lists.segments.members.all(listid, segmentid, count=count, offset=offset)
+    except Exception as e:
+        if is_timeout(e):
+            record_page(count, time.time() - start, True)
+        raise
+    # Pages replayed from the response cache say nothing about the API
+    if not response_cache.last_request_cached():
+        record_page(count, time.time() - start, False)
+
+    return response
+
+
+def record_page(count, seconds, timeout):
+    """ Append one page measurement to the export history """
+
+    line = ujson.dumps({'time': time.time(), 'count': count, 'seconds': seconds, 'timeout': timeout})
+    with _history_lock:
+        with open(EXPORT_HISTORY_FILE, 'a') as fp:
+            fp.write(line + '\n')
+
+    return
+
+
 def get_segment_members(listid, segmentid, merge_fields, count, offset, counter, parts):
     """ Get all members of a segment in pieces using offset and count"""
 
@@ -119,7 +172,7 @@ def get_segment_members(listid, segmentid, merge_fields, count, offset, counter,
             print('Current offset', offset)
             print('Current counter', counter)
             print('Getting members for next set')
-            response = client.lists.segments.members.all(listid, segmentid, count=count, offset=offset)
+            response = get_segment_page(listid, segmentid, count, offset)
             # Convert response to dictionary
             temp = offset + count
             if temp < total_members:
@@ -129,8 +182,7 @@ def get_segment_members(listid, segmentid, merge_fields, count, offset, counter,
 
             # Convert to csv
             temp_name_csv = "".join(seg_name.split()) + '-part-' + str(counter)
-            all_parts_csv.append(temp_name_csv + '.csv')
-            write_dict_to_csv(current_segment_dict, temp_name_csv, merge_fields)
+            all_parts_csv.append(write_dict_to_csv(current_segment_dict, temp_name_csv, merge_fields))
             offset = offset + count
             counter = counter + 1
             time.sleep(60)
@@ -153,6 +205,164 @@ def get_segment_members(listid, segmentid, merge_fields, count, offset, counter,
     return SUCCESS, offset, counter
 
 
+def segment_key(segment, default_list_id):
+    """ (list id, segment id) of a plan segment """
+
+    return segment.get('list_id', default_list_id), segment['id']
+
+
+def segment_file_names(plans):
+    """ Base name of the segment file of every plan segment, keyed by segment_key
+
+    Segments are written as <name>.csv, which the deduplication and the import read.
+    A name used by several segments (e.g. in different lists) gets the list and
+    segment id: <name> (<list id>-<segment id>).csv.
+    """
+
+    keys = [(segment_key(x, plan['list_id']), x['name']) for plan in plans for x in plan['segments']]
+    count = Counter(name for _, name in set(keys))
+    shared = sorted(name for name, n in count.items() if n > 1)
+    if shared:
+        print('Segment names used by several segments, written with list and segment id:', ', '.join(shared))
+
+    names = {}
+    for key, name in keys:
+        names[key] = '{} ({}-{})'.format(name, key[0], key[1]) if count[name] > 1 else name
+
+    return names
+
+
+def part_file_prefix(directory, key, part):
+    """ Part file prefix of one page of a segment: <list id>-<segment id>-part-<k> """
+
+    return os.path.join(directory, '{}-{}-part-{}'.format(key[0], key[1], part))
+
+
+def export_plan_segments(plan, scheduler, failed, names, dedup=None):
+    """ Queue the page requests of every segment of an export plan on the shared scheduler
+
+    Each page is written to a part file as soon as it arrives; the last page of a
+    segment merges the parts into the segment file, named by names (see
+    segment_file_names). Segments whose file already exists are skipped, so a
+    failed run can be repeated. Pages that time out are queued again at the front,
+    up to PAGE_RETRIES attempts. Keys (list id, segment id) of failed segments are
+    added to failed. Returns the number of members queued.
+
+    With a dedup (export_dedup.StreamingDedup) the segments are queued in its
+    priority order and their parts handed to it instead of being merged; segments
+    it has committed already are skipped, existing segment files are only filtered.
+    """
+
+    directory = os.path.abspath(plan['directory'])
+
+    def raw_name(segment):
+        return names[segment_key(segment, plan['list_id'])] + '.csv'
+
+    if dedup is None:
+        todo = [x for x in plan['segments']
+                if x['members'] > 0 and not segment_io.find_segment_file(raw_name(x), directory)]
+        exported = []
+    else:
+        import export_dedup
+        segments = [x for x in export_dedup.priority_order(plan['segments'])
+                    if x['members'] > 0 and segment_key(x, plan['list_id']) not in dedup.committed]
+        exported = [x for x in segments if segment_io.find_segment_file(raw_name(x), directory)]
+        todo = [x for x in segments if x not in exported]
+    print(plan['directory'], '-', len(plan['segments']) - len(todo), 'segments already exported or empty,',
+          len(todo), 'to go')
+
+    def fetch_part(segment, listid, state, k, offset, attempt):
+        key = (listid, segment['id'])
+        if key in failed:
+            return
+        try:
+            response = get_segment_page(listid, segment['id'], segment['count'], offset)
+        except Exception as e:
+            if is_timeout(e) and attempt < PAGE_RETRIES:
+                print('Timeout at offset', offset, 'of', segment['name'], '- retrying')
+                metrics.record_retry(metrics.endpoint_name('GET', 'lists/{}/segments/{}/members'.format(listid, segment['id'])))
+                scheduler.submit(listid, fetch_part, segment, listid, state, k, offset, attempt + 1, front=True)
+            else:
+                print('FAILED: segment', segment['id'], segment['name'], '-', repr(e))
+                failed.add(key)
+            return
+        try:
+            prefix = part_file_prefix(directory, key, k + 1)
+            current_segment_dict = create_segment_to_dict(response, plan['merge_fields'], len(response['members']))
+            state['parts'][k] = write_dict_to_csv(current_segment_dict, prefix, plan['merge_fields'])
+            with state['lock']:
+                state['pending'] -= 1
+                last = state['pending'] == 0
+            if last and dedup is not None:
+                print('SUCCESS! Exported segment', segment['id'], segment['name'])
+                metrics.record_stage('export_segment', time.perf_counter() - state['start'], segment['members'])
+                dedup.segment_done(key, state['parts'], os.path.join(directory, raw_name(segment)))
+            elif last:
+                merge_segments_create_audience(state['parts'], os.path.join(directory, raw_name(segment)))
+                for x in state['parts']:
+                    os.remove(x)
+                print('SUCCESS! Exported segment', segment['id'], segment['name'])
+                metrics.record_stage('export_segment', time.perf_counter() - state['start'], segment['members'])
+        except Exception as e:
+            print('FAILED: segment', segment['id'], segment['name'], '-', repr(e))
+            failed.add(key)
+
+    for segment in todo:
+        listid = segment.get('list_id', plan['list_id'])
+        offsets = list(range(0, segment['members'], segment['count']))
+        state = {'pending': len(offsets), 'parts': [None] * len(offsets), 'start': time.perf_counter(),
+                 'lock': threading.Lock()}
+
+        for k, offset in enumerate(offsets):
+            scheduler.submit(listid, fetch_part, segment, listid, state, k, offset, 1)
+
+    for segment in exported:
+        raw_file = os.path.join(directory, segment_io.find_segment_file(raw_name(segment), directory))
+        dedup.segment_done(segment_key(segment, plan['list_id']), [raw_file], raw_file, remove_parts=False)
+
+    return sum(x['members'] for x in todo)
+
+
+def run_export_plans(plan_files, dedup=False):
+    """ Export every segment of the export plans written by prepare_input_export.py
+
+    Plans may come from different lists (and a plan may mix lists); all of their
+    page requests share one budget of MAX_CONCURRENT_REQUESTS requests in flight
+    and MAX_REQUESTS_PER_SECOND, with the lists served in turn (export_scheduler.py).
+    With dedup the segments are deduplicated in priority order while they are
+    exported (export_dedup.py). Returns True if every segment was exported.
+    """
+
+    from export_scheduler import FairScheduler
+
+    plans = []
+    for plan_file in plan_files:
+        with open(plan_file) as fp:
+            plans.append(ujson.load(fp))
+    names = segment_file_names(plans)
+    streaming_dedup = None
+    if dedup:
+        import export_dedup
+        segments = [dict(x, list_id=x.get('list_id', plan['list_id'])) for plan in plans for x in plan['segments']]
+        order = export_dedup.priority_order([x for x in segments if x['members'] > 0])
+        streaming_dedup = export_dedup.StreamingDedup([segment_key(x, None) for x in order], names)
+    failed = set()
+    with metrics.stage('export_plans') as stage_info, \
+            FairScheduler(MAX_CONCURRENT_REQUESTS, MAX_REQUESTS_PER_SECOND) as scheduler:
+        for plan in plans:
+            stage_info['rows'] += export_plan_segments(plan, scheduler, failed, names, streaming_dedup)
+
+    if failed:
+        print(len(failed), 'segments failed:', ', '.join(sorted(names[x] for x in failed)))
+    if streaming_dedup is not None and streaming_dedup.waiting():
+        streaming_dedup.keep_raw()
+        print(len(streaming_dedup.waiting()), 'segments not deduplicated, re-run to finish:',
+              ', '.join(streaming_dedup.waiting()))
+        return False
+
+    return not failed
+
+
 def create_segment_to_dict(segment, merge_fields, nmem):
     """ Given segment members info, create a csv file
     """
@@ -189,10 +399,10 @@ def write_dict_to_csv(newdict_segment, file_prefix, merge_fields):
     # This also defines the headers of csv file basically
     all_fields = primary_fields + merge_fields
 
-    # Write to CSV
-    csv_file = file_prefix + ".csv"
+    # Write to CSV (compressed when MAILCHIMP_SEGMENT_COMPRESSION is set), atomically
+    csv_file = segment_io.segment_file(file_prefix + ".csv")
     try:
-        with open(csv_file,'w',encoding='utf-8-sig',newline='') as csvfile:
+        with segment_io.write_segment_atomic(csv_file) as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=all_fields)
             writer.writeheader()
             for data in newdict_segment:
@@ -205,14 +415,10 @@ def write_dict_to_csv(newdict_segment, file_prefix, merge_fields):
 
 
 def merge_segments_create_audience(all_segments_csv, filename):
-    """ Concatenate given dataframes to create one audience and write to file
+    """ Concatenate the part files of a segment into one file, streaming row by row
     """
 
-    all_dataframes = [pd.read_csv(x, encoding='utf_8_sig') for x in all_segments_csv]
-    bigdataframe = pd.concat(all_dataframes)
-    bigdataframe.to_csv(filename, index=False)
-
-    return
+    return segment_io.merge_segment_files(all_segments_csv, segment_io.segment_file(filename))
 
 
 def get_all_members_segment_batch(listid, segmentid):
@@ -248,6 +454,9 @@ def check_batch_operation_status(batchid):
 def get_file_from_response_url(segment_name, response_url):
     """ Download and extract the zip file from a response body URL"""
 
+    import requests
+    from tqdm import tqdm
+
     # Get the filename (Zip filename)
     filename = response_url.split('?')[0].split('/')[-1]
 
@@ -297,19 +506,20 @@ def get_segment_from_json_to_csv(segment_name):
 
     os.chdir('..')
 
-    f = csv.writer(open(segment_name+".csv", "w+"))
-    f.writerow(headers)
-    for member in all_members:
-        f.writerow([member['email_address'], 
-                    member['status'], 
-                    member['merge_fields']['FNAME'],
-                    member['merge_fields']['LNAME'],
-                    member['merge_fields']['PROVINCE'],
-                    member['merge_fields']['CITY'],
-                    member['merge_fields']['ZIP_CODE'],
-                    member['merge_fields']['MAKE'],
-                    member['merge_fields']['MODEL'],
-                    member['merge_fields']['YEAR']])
+    with segment_io.write_segment_atomic(segment_io.segment_file(segment_name + ".csv")) as fp:
+        f = csv.writer(fp)
+        f.writerow(headers)
+        for member in all_members:
+            f.writerow([member['email_address'],
+                        member['status'],
+                        member['merge_fields']['FNAME'],
+                        member['merge_fields']['LNAME'],
+                        member['merge_fields']['PROVINCE'],
+                        member['merge_fields']['CITY'],
+                        member['merge_fields']['ZIP_CODE'],
+                        member['merge_fields']['MAKE'],
+                        member['merge_fields']['MODEL'],
+                        member['merge_fields']['YEAR']])
 
     return
 
@@ -343,6 +553,12 @@ if __name__ == "__main__":
     # Get Audience Info
      #all_lists, all_lists_json = get_all_lists()
 
+    # Export everything in one or more plans written by prepare_input_export.py
+    # (--dedup: deduplicate in priority order while exporting, see export_dedup.py)
+    if sys.argv[1] == '--plan':
+        plan_files = [x for x in sys.argv[2:] if x != '--dedup']
+        sys.exit(0 if run_export_plans(plan_files, dedup='--dedup' in sys.argv[2:]) else 1)
+
     # Segment (or fitment) id read from command line
     segment_id = sys.argv[1]
     read_count = int(sys.argv[2])
@@ -357,14 +573,18 @@ if __name__ == "__main__":
     # Get segment members
     if EXPORT_SEGMENTS:
         os.chdir('All_segments')
-        status_export, last_offset, last_counter = get_segment_members(PARTSAVATAR_CUSTOMERS_LIST_ID, segment_id, merge_fields_pass, read_count, read_offset, read_counter, read_parts)
+        with metrics.stage('export_segment') as stage_info:
+            status_export, last_offset, last_counter = get_segment_members(PARTSAVATAR_CUSTOMERS_LIST_ID, segment_id, merge_fields_pass, read_count, read_offset, read_counter, read_parts)
+            stage_info['rows'] = min(last_offset, read_members) - read_offset
         #get_all_segment_members_direct(PARTSAVATAR_CUSTOMERS_LIST_ID, segment_id, merge_fields_pass)
     else:
         pass
 
     if EXPORT_FITMENTS:
         os.chdir('All_fitments')
-        status_export, last_offset, last_counter = get_segment_members(PARTSAVATAR_CUSTOMERS_LIST_ID, segment_id, merge_fields_pass, read_count, read_offset, read_counter, read_parts)
+        with metrics.stage('export_fitment') as stage_info:
+            status_export, last_offset, last_counter = get_segment_members(PARTSAVATAR_CUSTOMERS_LIST_ID, segment_id, merge_fields_pass, read_count, read_offset, read_counter, read_parts)
+            stage_info['rows'] = min(last_offset, read_members) - read_offset
     else:
         pass
 
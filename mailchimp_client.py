@@ -0,0 +1,59 @@
+"""
+MailChimp client shared by all scripts, built on first use
+
+mailchimp3 (and requests with it) is only imported when the first API call is
+made, so importing a script or running a code path that never talks to the API
+costs nothing. The API key and host come from the environment when set:
+
+    MAILCHIMP_API_KEY   API key (defaults to mc_api below)
+    MAILCHIMP_BASE_URL  API root, e.g. the local mock server (mock_mailchimp_server.py)
+
+GET responses of segment member pages can be cached on disk by the export, see response_cache.py.
+
+"""
+
+import os
+import threading
+
+# API key
+mc_api = os.environ.get('MAILCHIMP_API_KEY', " ")
+
+
+class LazyMailChimp(object):
+    """ Stands in for a mailchimp3.MailChimp instance and builds it on first attribute access """
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        import requests
+        from mailchimp3 import MailChimp
+        import metrics
+        import response_cache
+
+        headers = requests.utils.default_headers()
+        client = MailChimp(mc_api=mc_api, timeout=30.0, request_headers=headers)
+
+        if 'MAILCHIMP_BASE_URL' in os.environ:
+            client.base_url = os.environ['MAILCHIMP_BASE_URL']
+
+        # Record requests per endpoint (written out when MAILCHIMP_METRICS_DIR is set)
+        metrics.instrument_client(client)
+
+        # Replay member pages from disk (only when MAILCHIMP_RESPONSE_CACHE_DIR is set)
+        response_cache.install(client)
+
+        return client
+
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._build()
+
+        return getattr(self._client, name)
+
+
+# MailChimp client
+client = LazyMailChimp()
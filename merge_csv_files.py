@@ -1,13 +1,11 @@
 import sys
-import pandas as pd
+import segment_io
 
 def merge_segments_create_audience(all_segments_csv, filename):
-    """ Concatenate given dataframes to create one audience and write to file
+    """ Concatenate the given segment files (plain, .gz or .zst) into filename, streaming row by row
     """
 
-    all_dataframes = [pd.read_csv(x, encoding='utf_8_sig') for x in all_segments_csv]
-    bigdataframe = pd.concat(all_dataframes)
-    bigdataframe.to_csv(filename, index=False)
+    segment_io.merge_segment_files(all_segments_csv, filename)
 
     return
 
@@ -0,0 +1,111 @@
+"""
+On-disk cache for list, segment and merge-field metadata
+
+Lookups such as `lists/{id}`, `lists/{id}/segments/{id}` or `lists/{id}/merge-fields`
+are repeated by every script and every resumed export. `get_json` keeps their
+responses in METADATA_CACHE_DIR:
+
+    - younger than the TTL: served from disk, no request at all
+    - older: revalidated with If-None-Match when an ETag was stored (a 304 only
+      refreshes the timestamp), otherwise fetched again
+
+Values that must be current, such as the member_count of a segment that sets
+the paging bound of its export, are read with revalidate=True: the API is asked
+every time, and the ETag keeps that cheap when nothing changed.
+
+Settings from the environment:
+
+    MAILCHIMP_CACHE_DIR  cache directory (default ./.mailchimp_cache)
+    MAILCHIMP_CACHE_TTL  seconds an entry is used without asking the API (default 3600, 0 disables)
+
+"""
+
+import os, time
+import threading
+import hashlib, ujson
+
+from mailchimp_client import client
+
+# Absolute, the scripts change directories while running
+METADATA_CACHE_DIR = os.path.abspath(os.environ.get('MAILCHIMP_CACHE_DIR', './.mailchimp_cache'))
+METADATA_CACHE_TTL = float(os.environ.get('MAILCHIMP_CACHE_TTL', 3600))
+
+
+def cache_file(path, params):
+    """ File holding the cached response of path with query params """
+
+    key = path.strip('/') + '?' + '&'.join('{}={}'.format(k, params[k]) for k in sorted(params))
+
+    return os.path.join(METADATA_CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+
+def read_entry(filename):
+    """ Cached entry {'time', 'etag', 'value'}, or None """
+
+    try:
+        with open(filename) as fp:
+            return ujson.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def write_entry(filename, entry):
+    """ Write an entry atomically, concurrent readers never see half a file """
+
+    os.makedirs(METADATA_CACHE_DIR, exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as fp:
+        ujson.dump(entry, fp)
+    os.replace(tmp, filename)
+
+    return
+
+
+def request_json(path, etag=None, **params):
+    """ GET path through the shared client; returns (status code, ETag, JSON body or None) """
+
+    from urllib.parse import urljoin
+
+    headers = dict(client.request_headers)
+    if etag:
+        headers['If-None-Match'] = etag
+    r = client._make_request(method='GET', url=urljoin(client.base_url, path.lstrip('/')), params=params,
+                             auth=client.auth, headers=headers, hooks=client.request_hooks, timeout=client.timeout)
+    if r.status_code == 304:
+        return 304, etag, None
+    r.raise_for_status()
+
+    return r.status_code, r.headers.get('ETag'), r.json()
+
+
+def get_json(path, ttl=None, revalidate=False, **params):
+    """ Cached GET of an API path, e.g. get_json('lists/' + listid + '/segments/' + segmentid)
+
+    With revalidate, a cached entry is never used without asking the API (If-None-Match).
+    """
+
+    ttl = METADATA_CACHE_TTL if ttl is None else ttl
+    filename = cache_file(path, params)
+    entry = read_entry(filename) if ttl > 0 else None
+
+    if entry is not None and not revalidate and time.time() - entry['time'] < ttl:
+        return entry['value']
+
+    status, etag, value = request_json(path, entry['etag'] if entry else None, **params)
+    if status == 304:
+        value = entry['value']
+    if ttl > 0:
+        write_entry(filename, {'time': time.time(), 'etag': etag, 'value': value})
+
+    return value
+
+
+def invalidate(path, **params):
+    """ Drop a cached entry, e.g. after the resource was changed or deleted """
+
+    try:
+        os.remove(cache_file(path, params))
+    except OSError:
+        pass
+
+    return
@@ -0,0 +1,216 @@
+"""
+Request and stage metrics for the Mailchimp scripts
+
+Every script instruments its client with `instrument_client(client)` and wraps its
+work in `with stage('name'):`. Metrics are only written out when the environment
+variable MAILCHIMP_METRICS_DIR is set; then, at exit, each process appends
+
+    - one JSON line per stage and one summary line to `<dir>/metrics.jsonl`
+    - the current totals to `<dir>/<script>-<host>-<pid>.prom` (Prometheus textfile
+      collector format, one file and `pid` label per process, so concurrent runs of a
+      script never write the same series)
+
+Recorded: requests, errors, timeouts and retries per endpoint, a latency histogram
+per endpoint, bytes sent/received, and wall time and rows per second per stage.
+Stages recorded several times (e.g. once per segment) are summed per name in the
+Prometheus file.
+
+"""
+
+import os, sys, time
+import re, ujson
+import atexit
+import socket
+import threading
+import contextlib
+from collections import defaultdict
+
+# Absolute, the scripts change directories while running
+METRICS_DIR = os.environ.get('MAILCHIMP_METRICS_DIR')
+METRICS_DIR = os.path.abspath(METRICS_DIR) if METRICS_DIR else None
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Path segments that are ids (list ids, segment ids, subscriber hashes, batch ids)
+ID_PATTERN = re.compile(r'^([0-9a-f]{10}|[0-9a-f]{32}|\d+)$')
+
+_lock = threading.Lock()
+_requests = defaultdict(lambda: {'count': 0, 'errors': 0, 'timeouts': 0, 'retries': 0,
+                                 'bytes_sent': 0, 'bytes_received': 0, 'seconds': 0.0,
+                                 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+_stages = []
+_script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+
+
+def endpoint_name(method, url):
+    """ METHOD plus the URL path with ids replaced, e.g. GET /lists/{id}/segments/{id}/members """
+
+    path = url.split('?')[0].split('/3.0/')[-1]
+    parts = ['{id}' if ID_PATTERN.match(x) else x for x in path.strip('/').split('/')]
+
+    return '{} /{}'.format(method, '/'.join(parts))
+
+
+def record_request(endpoint, seconds, bytes_sent=0, bytes_received=0, error=False, timeout=False):
+    """ Add one request to the per-endpoint counters and latency histogram """
+
+    with _lock:
+        r = _requests[endpoint]
+        r['count'] += 1
+        r['errors'] += error
+        r['timeouts'] += timeout
+        r['bytes_sent'] += bytes_sent
+        r['bytes_received'] += bytes_received
+        r['seconds'] += seconds
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        r['buckets'][i] += 1
+
+    return
+
+
+def record_retry(endpoint):
+    """ Count a retried request (called by code that retries) """
+
+    with _lock:
+        _requests[endpoint]['retries'] += 1
+
+    return
+
+
+def instrument_client(client):
+    """ Wrap the request method of a mailchimp3 client so every call is recorded """
+
+    make_request = client._make_request
+
+    def timed_request(**kwargs):
+        endpoint = endpoint_name(kwargs['method'], kwargs['url'])
+        start = time.perf_counter()
+        try:
+            response = make_request(**kwargs)
+        except Exception as e:
+            timeout = isinstance(e, socket.timeout) or 'Timeout' in type(e).__name__
+            record_request(endpoint, time.perf_counter() - start, error=True, timeout=timeout)
+            raise
+        # Size of the body as sent (already serialized by requests), not serialized again here
+        body = response.request.body if response.request is not None else None
+        record_request(endpoint, time.perf_counter() - start, len(body) if body else 0, len(response.content),
+                       error=response.status_code >= 400)
+        return response
+
+    client._make_request = timed_request
+
+    return client
+
+
+@contextlib.contextmanager
+def stage(name):
+    """ Time a block of work; the yielded dict can be given a 'rows' count
+
+        with stage('dedup') as s:
+            ...
+            s['rows'] = n_rows
+    """
+
+    info = {'stage': name, 'script': _script, 'rows': 0}
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        info['seconds'] = time.perf_counter() - start
+        info['rows_per_second'] = info['rows'] / info['seconds'] if info['seconds'] > 0 else 0.0
+        with _lock:
+            _stages.append(info)
+
+
+def record_stage(name, seconds, rows=0):
+    """ Add a stage timed by the caller, e.g. work spread over several threads """
+
+    info = {'stage': name, 'script': _script, 'rows': rows, 'seconds': seconds,
+            'rows_per_second': rows / seconds if seconds > 0 else 0.0}
+    with _lock:
+        _stages.append(info)
+
+    return
+
+
+def summary():
+    """ Snapshot of all request and stage metrics of this process """
+
+    with _lock:
+        return {'script': _script, 'time': time.time(),
+                'requests': {k: dict(v, buckets=list(v['buckets'])) for k, v in _requests.items()},
+                'stages': list(_stages)}
+
+
+def labels_of_process():
+    """ Prometheus labels identifying this process """
+
+    return 'script="{}",host="{}",pid="{}"'.format(_script, socket.gethostname(), os.getpid())
+
+
+def prometheus_text(snapshot):
+    """ Render a summary() snapshot in the Prometheus text exposition format """
+
+    lines = []
+    counters = [('count', 'mailchimp_requests_total'), ('errors', 'mailchimp_request_errors_total'),
+                ('timeouts', 'mailchimp_request_timeouts_total'), ('retries', 'mailchimp_request_retries_total'),
+                ('bytes_sent', 'mailchimp_request_bytes_sent_total'),
+                ('bytes_received', 'mailchimp_request_bytes_received_total')]
+    for key, metric in counters:
+        lines.append('# TYPE {} counter'.format(metric))
+        for endpoint, r in sorted(snapshot['requests'].items()):
+            lines.append('{}{{{},endpoint="{}"}} {}'.format(metric, labels_of_process(), endpoint, r[key]))
+
+    lines.append('# TYPE mailchimp_request_duration_seconds histogram')
+    for endpoint, r in sorted(snapshot['requests'].items()):
+        labels = '{},endpoint="{}"'.format(labels_of_process(), endpoint)
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + ['+Inf'], r['buckets']):
+            cumulative += n
+            lines.append('mailchimp_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+        lines.append('mailchimp_request_duration_seconds_sum{{{}}} {}'.format(labels, r['seconds']))
+        lines.append('mailchimp_request_duration_seconds_count{{{}}} {}'.format(labels, r['count']))
+
+    # One series per stage name: stages recorded several times are summed
+    stages = {}
+    for s in snapshot['stages']:
+        total = stages.setdefault(s['stage'], {'seconds': 0.0, 'rows': 0, 'runs': 0})
+        total['seconds'] += s['seconds']
+        total['rows'] += s['rows']
+        total['runs'] += 1
+    for total in stages.values():
+        total['rows_per_second'] = total['rows'] / total['seconds'] if total['seconds'] > 0 else 0.0
+    for metric in ['seconds', 'rows', 'runs', 'rows_per_second']:
+        lines.append('# TYPE mailchimp_stage_{} gauge'.format(metric))
+        for name, total in sorted(stages.items()):
+            lines.append('mailchimp_stage_{}{{{},stage="{}"}} {}'.format(metric, labels_of_process(), name, total[metric]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics(metrics_dir=METRICS_DIR):
+    """ Append the JSON lines and rewrite the Prometheus textfile (no-op without a directory) """
+
+    if not metrics_dir:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    snapshot = summary()
+    if not snapshot['requests'] and not snapshot['stages']:
+        return
+
+    with open(os.path.join(metrics_dir, 'metrics.jsonl'), 'a') as fp:
+        for s in snapshot['stages']:
+            fp.write(ujson.dumps(dict(s, type='stage', time=snapshot['time'])) + '\n')
+        fp.write(ujson.dumps(dict(snapshot, type='summary')) + '\n')
+
+    # Textfile collectors may read at any moment, so write and rename
+    prom = os.path.join(metrics_dir, '{}-{}-{}.prom'.format(_script, socket.gethostname(), os.getpid()))
+    with open(prom + '.tmp', 'w') as fp:
+        fp.write(prometheus_text(snapshot))
+    os.replace(prom + '.tmp', prom)
+
+    return
+
+
+atexit.register(write_metrics)
@@ -0,0 +1,424 @@
+"""
+Local stand-in for the parts of the Mailchimp API used by this repository
+
+Usage:
+    python3 mock_mailchimp_server.py [--port 8080] [--members 10000] [--segments 20]
+                                     [--latency 0.05] [--latency-per-member 0.0005]
+                                     [--timeout-page-size 500] [--timeout-delay 60]
+                                     [--rate-limit 10]
+
+Point any script at it with
+
+    export MAILCHIMP_BASE_URL=http://127.0.0.1:8080/3.0/
+
+and a syntactically valid fake key, e.g. mc_api = "00000000000000000000000000000000-us1".
+
+Served endpoints (everything in memory, nothing persisted):
+
+    lists, lists/{id}                                   GET, POST, DELETE
+    lists/{id}/segments, lists/{id}/segments/{id}       GET
+    lists/{id}/segments/{id}/members                    GET (count/offset)
+    lists/{id}/merge-fields                             GET, POST
+    lists/{id}/members, lists/{id}/members/{hash}       GET, POST, PUT, PATCH, DELETE
+    lists/{id}/members/{hash}/actions/delete-permanent  POST
+    batches, batches/{id}                               GET, POST
+
+Batches are executed in a background thread against the same handlers and their
+results are served as a tar.gz `response_body_url`, like the real API.
+
+Load behaviour, to benchmark concurrency and backoff:
+
+    - every request sleeps latency + latency_per_member * (members returned)
+    - pages with count > timeout_page_size sleep timeout_delay (beyond the client timeout)
+    - more than rate_limit requests per second get a 429 response (0 = unlimited)
+
+GET responses carry an ETag and answer If-None-Match with 304 Not Modified.
+
+"""
+
+import io, sys, time
+import ujson, hashlib
+import tarfile
+import argparse
+import threading
+from itertools import count as counter
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_LIST_ID = '8adfbf295d'
+MOCK_TEMPLATE_LIST_ID = '776708c17f'
+PROVINCES = ['ON', 'QC', 'BC', 'AB', 'MB', 'SK', 'NS', 'NB', 'NL', 'PE']
+MAKES = {'TOYOTA': ['COROLLA', 'CAMRY', 'RAV4'], 'HONDA': ['CIVIC', 'ACCORD', 'CR-V'],
+         'FORD': ['F-150', 'ESCAPE', 'FOCUS'], 'CHEVROLET': ['SILVERADO', 'EQUINOX', 'CRUZE']}
+MERGE_FIELD_TAGS = ['FNAME', 'LNAME', 'PROVINCE', 'CITY', 'ZIP_CODE', 'MAKE', 'MODEL', 'YEAR']
+
+
+class ApiError(Exception):
+    """ Error answered in the Mailchimp problem-detail format """
+
+    def __init__(self, status, title, detail=''):
+        super().__init__(title)
+        self.status = status
+        self.title = title
+        self.detail = detail
+
+    def body(self):
+        return {'type': 'https://mailchimp.com/developer/marketing/docs/errors/',
+                'title': self.title, 'status': self.status, 'detail': self.detail, 'instance': ''}
+
+
+def get_subscriber_hash(email_address):
+    """ MD5 hash of the lowercased email, the member id Mailchimp uses in URLs
+    """
+
+    return hashlib.md5(email_address.strip().lower().encode('utf-8')).hexdigest()
+
+
+class MockMailchimp(object):
+    """ In-memory state and request handlers of the fake API """
+
+    def __init__(self, n_members, n_segments, base_url):
+        self.lock = threading.RLock()
+        self.base_url = base_url
+        self.ids = counter(1)
+        self.lists = {}
+        self.members = {}
+        self.merge_fields = {}
+        self.segments = {}
+        self.batches = {}
+        self.batch_results = {}
+
+        contact = {'company': 'PartsAvatar', 'address1': '1 Main St', 'city': 'Toronto', 'state': 'ON',
+                   'zip': 'M5V 1A1', 'country': 'CA'}
+        campaign_defaults = {'from_name': 'PartsAvatar', 'from_email': 'x@example.com', 'subject': '', 'language': 'en'}
+        for listid, name in [(MOCK_LIST_ID, 'PartsAvatar Customers'), (MOCK_TEMPLATE_LIST_ID, 'Template')]:
+            self.create_list(listid, {'name': name, 'contact': contact, 'campaign_defaults': campaign_defaults,
+                                      'permission_reminder': 'You signed up on our website.',
+                                      'email_type_option': False})
+            for tag in MERGE_FIELD_TAGS:
+                self.add_merge_field(listid, {'name': tag.lower(), 'type': 'text', 'tag': tag, 'public': True})
+
+        # Synthetic customers, segments are overlapping ranges of them
+        for i in range(n_members):
+            make = sorted(MAKES)[i % len(MAKES)]
+            member = {'email_address': 'customer{}@example.com'.format(i), 'status': 'subscribed',
+                      'merge_fields': {'FNAME': 'First{}'.format(i % 997), 'LNAME': 'Last{}'.format(i % 1009),
+                                       'PROVINCE': PROVINCES[i % len(PROVINCES)], 'CITY': 'City{}'.format(i % 101),
+                                       'ZIP_CODE': 'A{}B {}C{}'.format(i % 10, (i // 10) % 10, (i // 100) % 10),
+                                       'MAKE': make, 'MODEL': MAKES[make][i % 3], 'YEAR': 1995 + i % 26}}
+            self.put_member(MOCK_LIST_ID, member)
+        all_hashes = list(self.members[MOCK_LIST_ID])
+        for s in range(n_segments):
+            start = (s * n_members) // (n_segments + 1)
+            size = max(1, (2 * n_members) // (n_segments + 1))
+            segmentid = str(450000 + s)
+            self.segments[(MOCK_LIST_ID, segmentid)] = {'id': int(segmentid), 'name': 'Segment {}'.format(s),
+                                                        'list_id': MOCK_LIST_ID,
+                                                        'members': all_hashes[start:start + size]}
+
+    # State helpers
+
+    def create_list(self, listid, data):
+        with self.lock:
+            listid = listid or hashlib.md5(str(next(self.ids)).encode()).hexdigest()[:10]
+            if 'name' not in data:
+                raise ApiError(400, 'Invalid Resource', 'name is required')
+            self.lists[listid] = dict(data, id=listid)
+            self.members[listid] = {}
+            self.merge_fields[listid] = []
+            return self.lists[listid]
+
+    def add_merge_field(self, listid, data):
+        with self.lock:
+            fields = self.merge_fields[listid]
+            if any(x['tag'] == data.get('tag') for x in fields):
+                raise ApiError(400, 'Invalid Resource', 'A Merge Field with the tag already exists')
+            field = dict(data, merge_id=len(fields) + 1, list_id=listid)
+            fields.append(field)
+            return field
+
+    def put_member(self, listid, data, must_be_new=False, must_exist=False, subscriber_hash=None):
+        with self.lock:
+            if 'email_address' not in data and subscriber_hash is None:
+                raise ApiError(400, 'Invalid Resource', 'email_address is required')
+            subscriber_hash = subscriber_hash or get_subscriber_hash(data['email_address'])
+            existing = self.members[listid].get(subscriber_hash)
+            if existing is not None and must_be_new:
+                raise ApiError(400, 'Member Exists', '{} is already a list member.'.format(data['email_address']))
+            if existing is None and must_exist:
+                raise ApiError(404, 'Resource Not Found', 'The requested resource could not be found.')
+            member = dict(existing or {'id': subscriber_hash, 'list_id': listid, 'merge_fields': {}})
+            member['merge_fields'] = dict(member['merge_fields'], **data.get('merge_fields', {}))
+            for key in ('email_address', 'status'):
+                if key in data:
+                    member[key] = data[key]
+            if existing is None and 'status' not in member:
+                member['status'] = data.get('status_if_new', 'subscribed')
+            self.members[listid][subscriber_hash] = member
+            return member
+
+    def get_list_or_404(self, listid):
+        if listid not in self.lists:
+            raise ApiError(404, 'Resource Not Found', 'The requested resource could not be found.')
+        return self.lists[listid]
+
+    # Dispatch
+
+    def handle(self, method, parts, query, body):
+        """ Route one request; returns (status, response dict, number of members returned) """
+
+        count = int(query.get('count', 10))
+        offset = int(query.get('offset', 0))
+
+        if parts == ['lists']:
+            if method == 'POST':
+                return 200, self.create_list(None, body), 0
+            items = list(self.lists.values())
+            return 200, {'lists': items[offset:offset + count], 'total_items': len(items)}, 0
+
+        if parts[0] == 'lists' and len(parts) >= 2:
+            listid = parts[1]
+            current_list = self.get_list_or_404(listid)
+            rest = parts[2:]
+            if not rest:
+                if method == 'DELETE':
+                    with self.lock:
+                        del self.lists[listid]
+                    return 204, None, 0
+                return 200, current_list, 0
+
+            if rest == ['merge-fields']:
+                if method == 'POST':
+                    return 200, self.add_merge_field(listid, body), 0
+                items = self.merge_fields[listid]
+                return 200, {'merge_fields': items[offset:offset + count], 'total_items': len(items)}, 0
+
+            if rest[0] == 'segments':
+                if len(rest) == 1:
+                    items = [dict(x, member_count=len(x['members'])) for (l, _), x in self.segments.items()
+                             if l == listid]
+                    items = [{k: v for k, v in x.items() if k != 'members'} for x in items]
+                    return 200, {'segments': items[offset:offset + count], 'total_items': len(items)}, 0
+                segment = self.segments.get((listid, rest[1]))
+                if segment is None:
+                    raise ApiError(404, 'Resource Not Found', 'The requested segment could not be found.')
+                if len(rest) == 2:
+                    info = {k: v for k, v in segment.items() if k != 'members'}
+                    return 200, dict(info, member_count=len(segment['members'])), 0
+                page = [self.members[listid][h] for h in segment['members'][offset:offset + count]
+                        if h in self.members[listid]]
+                return 200, {'members': page, 'total_items': len(segment['members'])}, len(page)
+
+            if rest[0] == 'members':
+                if len(rest) == 1:
+                    if method == 'POST':
+                        return 200, self.put_member(listid, body, must_be_new=True), 1
+                    items = list(self.members[listid].values())
+                    if 'status' in query:
+                        items = [x for x in items if x['status'] == query['status']]
+                    page = items[offset:offset + count]
+                    return 200, {'members': page, 'total_items': len(items)}, len(page)
+                subscriber_hash = rest[1]
+                if (len(rest) == 4 and rest[2:] == ['actions', 'delete-permanent']) or method == 'DELETE':
+                    with self.lock:
+                        if self.members[listid].pop(subscriber_hash, None) is None:
+                            raise ApiError(404, 'Resource Not Found', 'The requested resource could not be found.')
+                    return 204, None, 0
+                if method == 'PUT':
+                    return 200, self.put_member(listid, body, subscriber_hash=subscriber_hash), 1
+                if method == 'PATCH':
+                    return 200, self.put_member(listid, body, must_exist=True, subscriber_hash=subscriber_hash), 1
+                member = self.members[listid].get(subscriber_hash)
+                if member is None:
+                    raise ApiError(404, 'Resource Not Found', 'The requested resource could not be found.')
+                return 200, member, 1
+
+        if parts[0] == 'batches':
+            if len(parts) == 1:
+                if method == 'POST':
+                    return 200, self.create_batch(body['operations']), 0
+                items = list(self.batches.values())
+                return 200, {'batches': items[offset:offset + count], 'total_items': len(items)}, 0
+            if parts[1] not in self.batches:
+                raise ApiError(404, 'Resource Not Found', 'The requested batch could not be found.')
+            return 200, self.batches[parts[1]], 0
+
+        raise ApiError(404, 'Resource Not Found', 'The requested resource could not be found.')
+
+    def handle_safe(self, method, parts, query, body):
+        """ handle() with ApiError turned into an error response """
+
+        try:
+            return self.handle(method, parts, query, body)
+        except ApiError as e:
+            return e.status, e.body(), 0
+        except (KeyError, ValueError, TypeError) as e:
+            return 400, ApiError(400, 'Invalid Resource', repr(e)).body(), 0
+
+    # Batches
+
+    def create_batch(self, operations):
+        with self.lock:
+            batchid = hashlib.md5(str(next(self.ids)).encode()).hexdigest()[:10]
+            batch = {'id': batchid, 'status': 'pending', 'total_operations': len(operations),
+                     'finished_operations': 0, 'errored_operations': 0,
+                     'submitted_at': time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime()),
+                     'completed_at': '', 'response_body_url': ''}
+            self.batches[batchid] = batch
+        threading.Thread(target=self.run_batch, args=(batchid, operations), daemon=True).start()
+
+        return batch
+
+    def run_batch(self, batchid, operations):
+        batch = self.batches[batchid]
+        batch['status'] = 'started'
+        results = []
+        for operation in operations:
+            body = operation.get('body')
+            body = ujson.loads(body) if isinstance(body, str) and body.startswith('{') else body
+            url = urlparse(operation['path'])
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            query.update({k: str(v) for k, v in (operation.get('params') or {}).items()})
+            parts = [x for x in url.path.split('/') if x and x != '3.0']
+            status, response, _ = self.handle_safe(operation['method'], parts, query, body)
+            results.append({'status_code': status, 'operation_id': operation.get('operation_id'),
+                            'response': ujson.dumps(response if response is not None else {})})
+            batch['finished_operations'] += 1
+            batch['errored_operations'] += status >= 400
+
+        # Results archive: one JSON array per 1000 operations, like the real API
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            for i in range(0, max(len(results), 1), 1000):
+                data = ujson.dumps(results[i:i + 1000]).encode('utf-8')
+                info = tarfile.TarInfo('{}-{}.json'.format(batchid, i // 1000))
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        self.batch_results[batchid] = buf.getvalue()
+        batch['response_body_url'] = '{}batch-results/{}-response.tar.gz'.format(self.base_url, batchid)
+        batch['completed_at'] = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime())
+        batch['status'] = 'finished'
+
+        return
+
+
+class RateLimiter(object):
+    """ Fixed one-second window request counter """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.window = 0
+        self.used = 0
+
+    def allow(self):
+        if not self.limit:
+            return True
+        with self.lock:
+            now = int(time.time())
+            if now != self.window:
+                self.window, self.used = now, 0
+            self.used += 1
+            return self.used <= self.limit
+
+
+def make_handler(api, limiter, config):
+    """ Request handler class bound to one MockMailchimp instance """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, format, *args):
+            if config.verbose:
+                BaseHTTPRequestHandler.log_message(self, format, *args)
+
+        def send_json(self, status, response, etag=False):
+            data = b'' if response is None else ujson.dumps(response).encode('utf-8')
+            if etag and status == 200:
+                # Weak validator over the body, 304 when the client already has it
+                tag = '"{}"'.format(hashlib.md5(data).hexdigest())
+                if self.headers.get('If-None-Match') == tag:
+                    self.send_response(304)
+                    self.send_header('ETag', tag)
+                    self.end_headers()
+                    return
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            if etag and status == 200:
+                self.send_header('ETag', tag)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def dispatch(self, method):
+            url = urlparse(self.path)
+            parts = [x for x in url.path.split('/') if x]
+            parts = parts[1:] if parts[:1] == ['3.0'] else parts
+
+            if parts[:1] == ['batch-results']:
+                data = api.batch_results.get(parts[1].split('-')[0])
+                if data is None:
+                    return self.send_json(404, ApiError(404, 'Resource Not Found').body())
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/gzip')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                return
+
+            if not limiter.allow():
+                return self.send_json(429, ApiError(429, 'Too Many Requests',
+                                                    'You have exceeded the limit of requests.').body())
+
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            body = ujson.loads(self.rfile.read(length)) if length else None
+
+            if config.timeout_page_size and int(query.get('count', 0)) > config.timeout_page_size:
+                time.sleep(config.timeout_delay)
+            status, response, n_members = api.handle_safe(method, parts or [''], query, body)
+            time.sleep(config.latency + config.latency_per_member * n_members)
+            self.send_json(status, response, etag=(method == 'GET'))
+
+        def do_GET(self):
+            self.dispatch('GET')
+
+        def do_POST(self):
+            self.dispatch('POST')
+
+        def do_PUT(self):
+            self.dispatch('PUT')
+
+        def do_PATCH(self):
+            self.dispatch('PATCH')
+
+        def do_DELETE(self):
+            self.dispatch('DELETE')
+
+    return Handler
+
+
+# MAIN
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Local stand-in for the Mailchimp API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--members', type=int, default=10000, help='Synthetic members in the customers list')
+    parser.add_argument('--segments', type=int, default=20, help='Overlapping segments of the customers list')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every request')
+    parser.add_argument('--latency-per-member', type=float, default=0.0005, help='Seconds per member returned')
+    parser.add_argument('--timeout-page-size', type=int, default=0, help='Pages above this count time out (0 = never)')
+    parser.add_argument('--timeout-delay', type=float, default=60.0, help='Seconds a timing-out page sleeps')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Requests per second before 429 (0 = unlimited)')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    base_url = 'http://{}:{}/3.0/'.format(args.host, args.port)
+    mock_api = MockMailchimp(args.members, args.segments, base_url)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(mock_api, RateLimiter(args.rate_limit), args))
+    print('Mock Mailchimp API on', base_url, 'with list', MOCK_LIST_ID, 'and', args.segments, 'segments')
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,224 @@
+"""
+Run the whole export -> deduplication -> audience pipeline with one command
+
+Usage:
+    python3 pipeline.py segments.csv audience.csv [STAGE ...] [--yes] [--dry-run] [--force STAGE]
+
+Stages and their dependencies:
+
+    prepare  (segments.csv)                 -> all_segments_info, run_export_segments
+    export   (run_export_segments)          -> All_segments
+    dedup    (segments.csv, All_segments)   -> All_segments_deduplicated
+    create   (audience.csv)                 -> created_audience_info
+    import   (All_segments_deduplicated, created_audience_info)
+
+Every stage records a fingerprint (path, size, mtime) of its inputs and outputs in
+PIPELINE_STATE_FILE. A stage is skipped when its inputs and outputs are unchanged
+since its last successful run. Stages whose dependencies are done run concurrently,
+so audience creation happens while the segments are exported.
+
+Giving STAGE names runs only those stages (and whatever they depend on).
+
+"""
+
+import os, sys
+import hashlib, ujson
+import subprocess
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+PIPELINE_STATE_FILE = '.pipeline_state.json'
+PATH_SEGMENT = './All_segments'
+PATH_DEDUP_SEG = './All_segments_deduplicated'
+
+
+def define_stages(segment_file, audience_file):
+    """ The pipeline DAG: name -> command, environment, dependencies, inputs, outputs """
+
+    python = sys.executable
+
+    stages = {
+        'prepare': {'command': [python, 'prepare_input_export.py', segment_file],
+                    'stdout': 'all_segments_info',
+                    'depends': [],
+                    'inputs': [segment_file, 'prepare_input_export.py'],
+                    'outputs': ['all_segments_info', 'run_export_segments', 'export_plan.json']},
+        'export': {'command': ['sh', 'run_export_segments'],
+                   'stdout': 'output_export_segments',
+                   'depends': ['prepare'],
+                   'inputs': ['run_export_segments', 'export_plan.json', 'export_segments.py'],
+                   'outputs': [PATH_SEGMENT]},
+        'dedup': {'command': [python, 'deduplication.py', segment_file],
+                  'stdout': 'output_deduplication',
+                  'depends': ['export'],
+                  'inputs': [segment_file, PATH_SEGMENT, 'deduplication.py'],
+                  'outputs': [PATH_DEDUP_SEG]},
+        'create': {'command': [python, 'write_audience_members.py', audience_file],
+                   'env': {'CREATE_NEW_AUDIENCE': 'True', 'WRITE_AUDIENCE_MEMBERS': 'False'},
+                   'stdout': 'output_create_audience',
+                   'depends': [],
+                   'inputs': [audience_file],
+                   'outputs': ['created_audience_info']},
+        'import': {'command': [python, 'write_audience_members.py', audience_file],
+                   'env': {'CREATE_NEW_AUDIENCE': 'False', 'WRITE_AUDIENCE_MEMBERS': 'True'},
+                   'stdout': 'output_write_audience',
+                   'confirm': True,
+                   'depends': ['dedup', 'create'],
+                   'inputs': [audience_file, PATH_DEDUP_SEG, 'created_audience_info'],
+                   'outputs': []},
+    }
+
+    return stages
+
+
+def fingerprint_paths(paths):
+    """ Hash of name, size and modification time of all files below the given paths
+
+    Returns None if any of the paths does not exist.
+    """
+
+    h = hashlib.sha1()
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, f) for root, _, filenames in os.walk(path) for f in filenames)
+        else:
+            files = [path]
+        for f in files:
+            st = os.stat(f)
+            h.update('{}|{}|{}\n'.format(f, st.st_size, st.st_mtime_ns).encode('utf-8'))
+
+    return h.hexdigest()
+
+
+def load_state():
+    """ Fingerprints recorded by previous runs """
+
+    if os.path.isfile(PIPELINE_STATE_FILE):
+        with open(PIPELINE_STATE_FILE) as fp:
+            return ujson.load(fp)
+
+    return {}
+
+
+def save_state(state):
+    """ Write the fingerprints atomically, so an interrupted run never corrupts them """
+
+    tmp = PIPELINE_STATE_FILE + '.tmp'
+    with open(tmp, 'w') as fp:
+        ujson.dump(state, fp, indent=4)
+    os.replace(tmp, PIPELINE_STATE_FILE)
+
+    return
+
+
+def is_up_to_date(stage, recorded):
+    """ True if inputs and outputs still match what the last successful run left behind """
+
+    if recorded is None or recorded['command'] != stage['command']:
+        return False
+
+    return (fingerprint_paths(stage['inputs']) == recorded['inputs'] and
+            fingerprint_paths(stage['outputs']) == recorded['outputs'])
+
+
+def run_stage(name, stage, assume_yes):
+    """ Run one stage as a subprocess, output redirected to its log file """
+
+    env = dict(os.environ)
+    env.update(stage.get('env', {}))
+    if stage.get('confirm') and assume_yes:
+        env['IMPORT_ASSUME_YES'] = 'True'
+    print('[{}] running: {} > {}'.format(name, ' '.join(stage['command']), stage['stdout']))
+    with open(stage['stdout'], 'w') as out:
+        if stage.get('confirm') and not assume_yes:
+            # Interactive confirmation must reach the terminal
+            returncode = subprocess.call(stage['command'], env=env)
+        else:
+            returncode = subprocess.call(stage['command'], env=env, stdout=out, stderr=subprocess.STDOUT,
+                                         stdin=subprocess.DEVNULL)
+    if returncode != 0:
+        raise RuntimeError('Stage {} failed with exit code {}, see {}'.format(name, returncode, stage['stdout']))
+    print('[{}] done'.format(name))
+
+    return
+
+
+def select_stages(stages, targets):
+    """ The requested stages plus everything they depend on """
+
+    if not targets:
+        return set(stages)
+
+    selected = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in stages:
+            raise ValueError('Unknown stage ' + name)
+        if name not in selected:
+            selected.add(name)
+            todo.extend(stages[name]['depends'])
+
+    return selected
+
+
+def run_pipeline(stages, targets=(), force=(), dry_run=False, assume_yes=False):
+    """ Run the selected stages in dependency order, independent ones concurrently """
+
+    state = load_state()
+    selected = select_stages(stages, targets)
+    done = set(x for x in stages if x not in selected)
+    rerun = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+        while len(done) < len(stages):
+            for name in sorted(selected - done - set(running.values())):
+                stage = stages[name]
+                if not all(x in done for x in stage['depends']):
+                    continue
+                upstream_rerun = any(x in rerun for x in stage['depends'])
+                if name not in force and not upstream_rerun and is_up_to_date(stage, state.get(name)):
+                    print('[{}] up to date, skipping'.format(name))
+                    done.add(name)
+                    continue
+                rerun.add(name)
+                if dry_run:
+                    print('[{}] would run: {}'.format(name, ' '.join(stage['command'])))
+                    done.add(name)
+                    continue
+                running[executor.submit(run_stage, name, stage, assume_yes)] = name
+
+            if not running:
+                continue
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                future.result()
+                state[name] = {'command': stages[name]['command'],
+                               'inputs': fingerprint_paths(stages[name]['inputs']),
+                               'outputs': fingerprint_paths(stages[name]['outputs'])}
+                save_state(state)
+                done.add(name)
+
+    return
+
+
+# MAIN
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Run the Mailchimp export/dedup/import pipeline')
+    parser.add_argument('segment_file', help='CSV with Segment Name, Segment id and List Name')
+    parser.add_argument('audience_file', help='CSV with Segment Name and List Name of the new audiences')
+    parser.add_argument('stages', nargs='*', help='Only run these stages (and their dependencies)')
+    parser.add_argument('--force', action='append', default=[], metavar='STAGE',
+                        help='Re-run this stage even if up to date (can be repeated)')
+    parser.add_argument('--dry-run', action='store_true', help='Only print what would run')
+    parser.add_argument('--yes', action='store_true', help='Do not ask for confirmation before importing')
+    args = parser.parse_args()
+
+    all_stages = define_stages(args.segment_file, args.audience_file)
+    run_pipeline(all_stages, args.stages, args.force, args.dry_run, args.yes)
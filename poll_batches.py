@@ -0,0 +1,155 @@
+"""
+Watch many batch operations at once and download their results as they finish
+
+Usage:
+    python3 poll_batches.py BATCH_ID [BATCH_ID ...]
+    python3 poll_batches.py batch_ids.txt        (one id per line)
+
+Each batch is polled with exponential backoff (POLL_MIN_WAIT doubling up to
+POLL_MAX_WAIT), so short batches are picked up quickly while long ones do not
+hammer the API. As soon as a batch is finished its response archive is
+downloaded into PATH_BATCH_RESULTS/<batch_id>. A failed status request (timeout,
+5xx, 429) only backs that batch off; after MAX_POLL_ERRORS failures in a row the
+batch is given up on.
+
+"""
+
+import os, sys, time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+PATH_BATCH_RESULTS = './All_batch_results'
+DOWNLOAD_RESULTS = True
+POLL_MIN_WAIT = 5
+POLL_MAX_WAIT = 120
+MAX_WORKERS = 8
+MAX_POLL_ERRORS = 10
+
+# MailChimp client, built on first use
+from mailchimp_client import client
+
+
+def read_batch_ids(args):
+    """ Batch ids from the command line, or from a file with one id per line
+    """
+
+    if len(args) == 1 and os.path.isfile(args[0]):
+        return [x.strip() for x in open(args[0]).readlines() if x.strip()]
+
+    return args
+
+
+def get_batch_info(batchid):
+    """ Status of a batch, or None if the request failed """
+
+    try:
+        return client.batch_operations.get(batchid)
+    except Exception as e:
+        print('Could not get status of', batchid, '-', repr(e))
+        return None
+
+
+def download_batch_result(batchid, response_url):
+    """ Stream the response archive of a finished batch to disk """
+
+    import requests
+
+    Path(PATH_BATCH_RESULTS).mkdir(parents=True, exist_ok=True)
+    filename = os.path.join(PATH_BATCH_RESULTS, batchid + '-response.tar.gz')
+
+    r = requests.get(response_url, stream=True, allow_redirects=True)
+    r.raise_for_status()
+    with open(filename, 'wb') as f:
+        for ch in r.iter_content(chunk_size=1024*1024):
+            if ch:
+                f.write(ch)
+
+    return filename
+
+
+def print_summary(batches, start_time):
+    """ One status line per batch, followed by totals and throughput """
+
+    elapsed = time.time() - start_time
+    total = finished = errored = done = 0
+    for batchid, info in batches.items():
+        print('{}  {:<12} {:>8}/{:<8} errors: {}'.format(batchid, info['status'], info['finished_operations'],
+                                                          info['total_operations'], info['errored_operations']))
+        total += info['total_operations']
+        finished += info['finished_operations']
+        errored += info['errored_operations']
+        done += info['status'] == 'finished'
+
+    print('BATCHES DONE: {}/{}  OPERATIONS: {}/{}  ERRORS: {}  THROUGHPUT: {:.1f} ops/s'.format(
+          done, len(batches), finished, total, errored, finished / max(elapsed, 1e-6)))
+    print()
+
+    return
+
+
+def poll_batches(batch_ids):
+    """ Poll all batch ids concurrently until every one of them is finished
+
+    Returns a dictionary batch id -> last batch info, plus 'result_file' for finished
+    batches with a result archive (None, with 'download_error', if its download failed).
+    """
+
+    batches = {x: {'status': 'unknown', 'total_operations': 0, 'finished_operations': 0,
+                   'errored_operations': 0} for x in batch_ids}
+    wait = {x: POLL_MIN_WAIT for x in batch_ids}
+    next_poll = {x: 0.0 for x in batch_ids}
+    errors = {x: 0 for x in batch_ids}
+    start_time = time.time()
+    pending = set(batch_ids)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        downloads = {}
+        while pending:
+            now = time.time()
+            due = [x for x in pending if next_poll[x] <= now]
+            for batchid, response in zip(due, executor.map(get_batch_info, due)):
+                if response is None:
+                    errors[batchid] += 1
+                    if errors[batchid] >= MAX_POLL_ERRORS:
+                        print('Giving up on', batchid, 'after', errors[batchid], 'failed status requests')
+                        batches[batchid]['status'] = 'poll failed'
+                        pending.discard(batchid)
+                        continue
+                else:
+                    errors[batchid] = 0
+                    batches[batchid].update(response)
+                if response is not None and response['status'] == 'finished':
+                    pending.discard(batchid)
+                    if DOWNLOAD_RESULTS and response['response_body_url']:
+                        downloads[batchid] = executor.submit(download_batch_result, batchid,
+                                                             response['response_body_url'])
+                else:
+                    # Back off, progress or not (or error); finished batches are picked up within POLL_MAX_WAIT
+                    next_poll[batchid] = now + wait[batchid]
+                    wait[batchid] = min(wait[batchid] * 2, POLL_MAX_WAIT)
+
+            if due:
+                print_summary(batches, start_time)
+            if pending:
+                time.sleep(max(0.0, min(next_poll[x] for x in pending) - time.time()))
+
+        for batchid, future in downloads.items():
+            try:
+                batches[batchid]['result_file'] = future.result()
+            except Exception as e:
+                print('Could not download result of', batchid, '-', repr(e))
+                batches[batchid]['result_file'] = None
+                batches[batchid]['download_error'] = repr(e)
+                continue
+            print('Downloaded result of', batchid, 'to', batches[batchid]['result_file'])
+
+    return batches
+
+
+# MAIN
+if __name__ == "__main__":
+
+    all_batch_ids = read_batch_ids(sys.argv[1:])
+    print('Watching', len(all_batch_ids), 'batch operations')
+    print()
+    poll_batches(all_batch_ids)
@@ -1,41 +1,136 @@
-import csv
-import requests
-import os, sys, time
+import csv, ujson
+import os, sys, time, math
 import numpy as np
 from subprocess import call
 from pathlib import Path
-from mailchimp3 import MailChimp
 from tabulate import tabulate
+from concurrent.futures import ThreadPoolExecutor
 
 
 EXPORT_SEGMENTS = True
 EXPORT_FITMENTS = False
 
-# API key
-mc_api = " "
-
-# MailChimp client
-headers = requests.utils.default_headers()
-client = MailChimp(mc_api=mc_api, timeout=30.0, request_headers=headers)
-
-# List id
+# Export planning
+EXPORT_HISTORY_FILE = 'export_history.jsonl'     # written by export_segments.py
+PAGE_SIZES = [50, 100, 150, 200, 250, 300, 400, 500, 750, 1000]
+MIN_HISTORY = 20                # pages needed before the measured model replaces the defaults
+REQUEST_TIMEOUT = 30.0          # client timeout, what a timed out page costs on top of a retry
+MAX_PAGE_WORKERS = 4            # parallel page requests per segment, for the time estimate
+MAX_WORKERS = 8                 # parallel segment info requests
+MERGE_FIELDS = ['FNAME', 'LNAME', 'CITY', 'PROVINCE', 'ZIP_CODE', 'YEAR', 'MAKE', 'MODEL']
+FILL_JOB_QUEUE = False          # also queue one job per page for export_queue.py workers
+
+# MailChimp client, built on first use
+from mailchimp_client import client
+import metadata_cache
+
+# List id, used for segments without a 'List id' column in the segments file
 PARTSAVATAR_CUSTOMERS_LIST_ID = "8adfbf295d"     # PartsAvatar Customers
 
 
 def get_info_segment(listid, segmentid):
-    """ Get information on a particular segment by id"""
+    """ Get information on a particular segment by id
+
+    Always revalidated (see metadata_cache.py): member_count sets how many pages are exported.
+    """
 
-    response = client.lists.segments.get(listid, segmentid)
+    response = metadata_cache.get_json('lists/' + listid + '/segments/' + str(segmentid), revalidate=True)
     segment_name = response['name']
     segment_member_count = response['member_count']
 
     return segment_name, segment_member_count
 
 
+def default_page_size(nmem):
+    """ Page size used when there is not enough export history to fit the cost model """
+
+    if nmem <= 200:
+        return 50
+    elif nmem <= 600:
+        return 100
+    elif nmem <= 800:
+        return 150
+    elif nmem <= 1000:
+        return 200
+    else:
+        return 500
+
+
+def load_export_history(history_file):
+    """ Page measurements recorded by export_segments.py """
+
+    if not os.path.isfile(history_file):
+        return []
+
+    with open(history_file) as fp:
+        return [ujson.loads(line) for line in fp if line.strip()]
+
+
+def fit_page_cost_model(history):
+    """ Fit latency = a + b * count on successful pages and smoothed timeout rates per size
+
+    Returns (latency(count), timeout_rate(count)) functions, or None without enough history.
+    """
+
+    ok = [(x['count'], x['seconds']) for x in history if not x['timeout']]
+    if len(history) < MIN_HISTORY or len(set(c for c, _ in ok)) < 2:
+        return None
+
+    # Least squares line through (count, seconds)
+    n = len(ok)
+    mean_c = sum(c for c, _ in ok) / n
+    mean_s = sum(s for _, s in ok) / n
+    b = sum((c - mean_c) * (s - mean_s) for c, s in ok) / sum((c - mean_c) ** 2 for c, _ in ok)
+    b = max(b, 0.0)
+    a = max(mean_s - b * mean_c, 0.0)
+    overall_rate = sum(x['timeout'] for x in history) / len(history)
+
+    def latency(count):
+        return a + b * count
+
+    def timeout_rate(count):
+        # Pages of similar size, shrunk towards the overall rate (5 pseudo-observations)
+        similar = [x['timeout'] for x in history if count / 1.5 <= x['count'] <= count * 1.5]
+        return (sum(similar) + 5 * overall_rate) / (len(similar) + 5)
+
+    return latency, timeout_rate
+
+
+def plan_segment(nmem, model):
+    """ Page size, number of parts and expected seconds for one segment
+
+    Minimises the expected time: every page costs its latency, and a timed out page
+    costs REQUEST_TIMEOUT plus another attempt, p / (1 - p) extra attempts on average.
+    The estimate assumes up to MAX_PAGE_WORKERS pages of the segment in flight; the
+    export itself shares one request budget between all segments (export_segments.py).
+    """
+
+    if model is None:
+        count = default_page_size(nmem)
+        expected = None
+    else:
+        latency, timeout_rate = model
+        best = None
+        for count in PAGE_SIZES:
+            p = min(timeout_rate(count), 0.95)
+            pages = max(1, math.ceil(nmem / count))
+            cost = pages * (latency(count) + p / (1 - p) * (REQUEST_TIMEOUT + latency(count)))
+            if best is None or cost < best[1]:
+                best = (count, cost)
+        count, expected = best
+
+    n_parts = max(1, math.ceil(nmem / count))
+    if expected is not None:
+        expected = expected / min(MAX_PAGE_WORKERS, n_parts)
+
+    return count, n_parts, expected
+
+
 # Read segments info from segments.csv
 segments_info_file = sys.argv[1]
 all_segments_id = []
 all_segments_name = []
+all_segments_list = []
 with open(segments_info_file, "r") as csv_file:
     csv_reader = csv.DictReader(csv_file, delimiter=',')
     if EXPORT_SEGMENTS:
@@ -43,21 +138,25 @@ with open(segments_info_file, "r") as csv_file:
         for lines in csv_reader:
             all_segments_id.append(lines['Segment id'])
             all_segments_name.append(lines['Segment Name'])
+            all_segments_list.append(lines.get('List id') or PARTSAVATAR_CUSTOMERS_LIST_ID)
     elif EXPORT_FITMENTS:
         Path('./All_fitments').mkdir(parents=True, exist_ok=True)
         for lines in csv_reader:
             all_segments_id.append(lines['Fitment id'])
             all_segments_name.append(lines['Fitment Name'])
+            all_segments_list.append(lines.get('List id') or PARTSAVATAR_CUSTOMERS_LIST_ID)
     else:
-        pass
+        sys.exit('Neither EXPORT_SEGMENTS nor EXPORT_FITMENTS is set in prepare_input_export.py, nothing to plan')
 
 # Get name and members, make sure name matches from API call and 
 # what has been provided.
 n_segments = len(all_segments_id)
 all_segments_members = []
-all_segments = [['ID', 'NAME', 'MEMBERS']]
+all_segments = [['LIST', 'ID', 'NAME', 'MEMBERS', 'COUNT', 'PARTS']]
+with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    all_segments_info = list(executor.map(get_info_segment, all_segments_list, all_segments_id))
 for i in range(n_segments):
-    sname, smem = get_info_segment(PARTSAVATAR_CUSTOMERS_LIST_ID, all_segments_id[i])
+    sname, smem = all_segments_info[i]
     assert sname == all_segments_name[i]
     all_segments_members.append(smem)
 
@@ -66,55 +165,43 @@ for i in range(n_segments):
 index_members_sort = np.argsort(all_segments_members)
 index_members = index_members_sort.tolist()
 sorted_segment_id = [all_segments_id[i] for i in index_members]
+sorted_segment_list = [all_segments_list[i] for i in index_members]
 sorted_segment_name = [all_segments_name[i] for i in index_members]
 sorted_segment_members = [all_segments_members[i] for i in index_members]
 
+# Page size from the measured cost model (or the defaults)
+page_cost_model = fit_page_cost_model(load_export_history(EXPORT_HISTORY_FILE))
+if page_cost_model is None:
+    print('Not enough export history in', EXPORT_HISTORY_FILE, '- using default page sizes')
+all_plans = [plan_segment(nmem, page_cost_model) for nmem in sorted_segment_members]
+
 for j in range(n_segments):
-    all_segments.append([sorted_segment_id[j], sorted_segment_name[j], sorted_segment_members[j]])
+    count, n_parts, expected = all_plans[j]
+    all_segments.append([sorted_segment_list[j], sorted_segment_id[j], sorted_segment_name[j], sorted_segment_members[j], count, n_parts])
 
 print(tabulate(all_segments, headers='firstrow', showindex='always', tablefmt='plain'))
 
-# Create a reasonable value of COUNT based on total number of members in a segment
-all_counts = []
-all_parts = []
-for i in range(n_segments):
-    nmem = sorted_segment_members[i]
-    if nmem < 200:
-        count = 50
-    elif nmem > 200 and nmem < 600:
-        count = 100
-    elif nmem > 600 and nmem < 800:
-        count = 150
-    elif nmem > 800 and nmem < 1000:
-        count = 200
-    else:
-        count = 500
-
-    div_mod = divmod(nmem, count)
-    quotient = div_mod[0]
-    remainder = div_mod[1]
-    if remainder > 0:
-        n_parts = quotient + 1
-    else:
-        n_parts = quotient
-
-    all_counts.append(count)
-    all_parts.append(n_parts)
-
-# Write to file
+# Write the export plan, and a run file executing it
 if EXPORT_SEGMENTS:
-    fwrite = open('run_export_segments', 'w')
-    fwrite.write('# ID, COUNT, OFFSET, COUNTER, MEMBERS, PARTS \n')
-    for i in range(n_segments):
-        fwrite.write('python3 export_segments.py {} {} {} {} {} {} \n'.format(sorted_segment_id[i], all_counts[i], 0, 1, sorted_segment_members[i], all_parts[i]))
-        fwrite.write('sleep 100\n')
-    fwrite.close()
-elif EXPORT_FITMENTS:
-    fwrite = open('run_export_fitments', 'w')
-    fwrite.write('# ID, COUNT, OFFSET, COUNTER, MEMBERS, PARTS \n')
-    for i in range(n_segments):
-        fwrite.write('python3 export_fitments.py {} {} {} {} {} {} \n'.format(sorted_segment_id[i], all_counts[i], 0, 1, sorted_segment_members[i], all_parts[i]))
-        fwrite.write('sleep 30\n')
-    fwrite.close()
+    plan_file, run_file, directory = 'export_plan.json', 'run_export_segments', 'All_segments'
 else:
-    pass
+    plan_file, run_file, directory = 'export_fitments_plan.json', 'run_export_fitments', 'All_fitments'
+
+export_plan = {'list_id': PARTSAVATAR_CUSTOMERS_LIST_ID,
+               'directory': directory,
+               'merge_fields': MERGE_FIELDS,
+               'cost_model': page_cost_model is not None,
+               'segments': [{'list_id': sorted_segment_list[j], 'id': sorted_segment_id[j], 'name': sorted_segment_name[j],
+                             'members': sorted_segment_members[j], 'count': all_plans[j][0],
+                             'parts': all_plans[j][1], 'expected_seconds': all_plans[j][2]}
+                            for j in range(n_segments)]}
+with open(plan_file, 'w') as fp:
+    ujson.dump(export_plan, fp, indent=4)
+
+with open(run_file, 'w') as fwrite:
+    fwrite.write('python3 export_segments.py --plan {}\n'.format(plan_file))
+
+# Page jobs for worker processes (python3 export_queue.py work), instead of the run file
+if FILL_JOB_QUEUE:
+    import export_queue
+    print('Added', export_queue.fill_queue(plan_file), 'jobs to', export_queue.JOB_QUEUE_DIR)
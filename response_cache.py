@@ -0,0 +1,197 @@
+"""
+Opt-in on-disk cache of API GET responses, to replay member pages on re-runs
+
+Re-running an export after fixing the CSV conversion should not download every
+member page again. When MAILCHIMP_RESPONSE_CACHE_DIR is set and the script has
+called enable() (only export_segments.py does), GET requests whose path matches
+RESPONSE_CACHE_PATTERNS (segment member pages) are kept on disk, keyed by URL
+and query (count, offset, fields, ...):
+
+    - younger than MAILCHIMP_RESPONSE_CACHE_MAX_AGE seconds: replayed, no request
+    - older: revalidated with If-None-Match when the API sent an ETag (a 304
+      refreshes the entry), otherwise fetched again
+
+Bodies are stored gzip compressed. The directory is kept below
+MAILCHIMP_RESPONSE_CACHE_MAX_MB by evicting the least recently used entries
+(every hit refreshes the modification time of its file).
+
+List member reads are never cached: the member sync and deletes of
+write_audience_members.py and deduplication.py must see the current list, even
+when the variable is still set in the environment.
+
+Small metadata lookups are cached separately with a short TTL, see metadata_cache.py.
+
+"""
+
+import os, re, time
+import gzip, ujson, hashlib
+import threading
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+RESPONSE_CACHE_DIR = os.environ.get('MAILCHIMP_RESPONSE_CACHE_DIR')
+RESPONSE_CACHE_DIR = os.path.abspath(RESPONSE_CACHE_DIR) if RESPONSE_CACHE_DIR else None
+RESPONSE_CACHE_MAX_BYTES = float(os.environ.get('MAILCHIMP_RESPONSE_CACHE_MAX_MB', 2048)) * 1e6
+RESPONSE_CACHE_MAX_AGE = float(os.environ.get('MAILCHIMP_RESPONSE_CACHE_MAX_AGE', 7 * 86400))
+RESPONSE_CACHE_PATTERNS = [r'/lists/\w+/segments/\w+/members$']
+
+_lock = threading.Lock()
+_local = threading.local()
+_size = [None]              # bytes in the cache directory, scanned on first write
+_enabled = [False]          # set by enable(), from the export only
+
+
+def enable():
+    """ Use the cache for this process (export scripts only) """
+
+    _enabled[0] = True
+
+    return
+
+
+def cacheable(url):
+    """ True for GET URLs whose responses may be cached """
+
+    path = urlsplit(url).path.rstrip('/')
+
+    return any(re.search(x, path) for x in RESPONSE_CACHE_PATTERNS)
+
+
+def cache_file(url):
+    """ Cache file of a URL; query parameters are sorted so their order does not matter """
+
+    parts = urlsplit(url)
+    key = '{}://{}{}?{}'.format(parts.scheme, parts.netloc, parts.path.rstrip('/'),
+                                urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True))))
+
+    return os.path.join(RESPONSE_CACHE_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.gz')
+
+
+def read_entry(filename):
+    """ (metadata dict, body bytes) of a cache file, or None """
+
+    try:
+        with gzip.open(filename, 'rb') as fp:
+            meta = ujson.loads(fp.readline())
+            return meta, fp.read()
+    except (IOError, OSError, ValueError, EOFError):
+        return None
+
+
+def write_entry(filename, meta, body):
+    """ Store an entry atomically and evict old entries if the cache grew too large """
+
+    os.makedirs(RESPONSE_CACHE_DIR, exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    with gzip.open(tmp, 'wb', compresslevel=6) as fp:
+        fp.write(ujson.dumps(meta).encode('utf-8') + b'\n')
+        fp.write(body)
+    size = os.path.getsize(tmp)
+    try:
+        replaced = os.path.getsize(filename)
+    except FileNotFoundError:
+        replaced = 0
+    os.replace(tmp, filename)
+
+    with _lock:
+        if _size[0] is None:
+            _size[0] = sum(os.path.getsize(os.path.join(RESPONSE_CACHE_DIR, x))
+                           for x in os.listdir(RESPONSE_CACHE_DIR) if x.endswith('.gz'))
+        else:
+            _size[0] += size - replaced
+        if _size[0] > RESPONSE_CACHE_MAX_BYTES:
+            _size[0] = evict(RESPONSE_CACHE_MAX_BYTES * 0.9)
+
+    return
+
+
+def evict(target_bytes):
+    """ Delete least recently used entries until the cache holds at most target_bytes; returns the size left """
+
+    entries = []
+    for x in os.listdir(RESPONSE_CACHE_DIR):
+        if x.endswith('.gz'):
+            try:
+                st = os.stat(os.path.join(RESPONSE_CACHE_DIR, x))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, x))
+    entries.sort()
+
+    total = sum(x[1] for x in entries)
+    for _, size, name in entries:
+        if total <= target_bytes:
+            break
+        try:
+            os.remove(os.path.join(RESPONSE_CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+        total -= size
+
+    return total
+
+
+def cached_response(url, meta, body):
+    """ A requests.Response carrying a cached body """
+
+    import requests
+
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = body
+    response.url = url
+    response.encoding = 'utf-8'
+    response.headers['Content-Type'] = meta.get('content_type') or 'application/json'
+    if meta.get('etag'):
+        response.headers['ETag'] = meta['etag']
+
+    return response
+
+
+def last_request_cached():
+    """ True if the last request made by this thread was answered from the cache """
+
+    return getattr(_local, 'hit', False)
+
+
+def install(client):
+    """ Put the cache in front of the request method of a mailchimp3 client (no-op when disabled)
+
+    Requests pass straight through until enable() has been called.
+    """
+
+    if not RESPONSE_CACHE_DIR:
+        return client
+
+    import metrics
+
+    make_request = client._make_request
+
+    def cached_request(**kwargs):
+        _local.hit = False
+        if not _enabled[0] or kwargs['method'] != 'GET' or not cacheable(kwargs['url']):
+            return make_request(**kwargs)
+
+        start = time.perf_counter()
+        filename = cache_file(kwargs['url'])
+        entry = read_entry(filename)
+        if entry is not None and time.time() - entry[0]['time'] < RESPONSE_CACHE_MAX_AGE:
+            os.utime(filename, None)
+            _local.hit = True
+            metrics.record_request('CACHE ' + metrics.endpoint_name('GET', kwargs['url']),
+                                   time.perf_counter() - start, bytes_received=len(entry[1]))
+            return cached_response(kwargs['url'], *entry)
+
+        if entry is not None and entry[0].get('etag'):
+            kwargs['headers'] = dict(kwargs.get('headers') or {}, **{'If-None-Match': entry[0]['etag']})
+        response = make_request(**kwargs)
+        if response.status_code == 304 and entry is not None:
+            write_entry(filename, dict(entry[0], time=time.time()), entry[1])
+            return cached_response(kwargs['url'], *entry)
+        if response.status_code == 200:
+            write_entry(filename, {'url': kwargs['url'], 'time': time.time(), 'etag': response.headers.get('ETag'),
+                                   'content_type': response.headers.get('Content-Type')}, response.content)
+        return response
+
+    client._make_request = cached_request
+
+    return client
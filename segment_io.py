@@ -0,0 +1,177 @@
+"""
+Reading and writing segment CSV files, plain or compressed
+
+Segment files may be stored as `name.csv`, `name.csv.gz` or `name.csv.zst`; the
+codec follows from the file name and is applied while streaming, nothing is
+ever decompressed to disk. New segment files are written with the codec set in
+the environment:
+
+    MAILCHIMP_SEGMENT_COMPRESSION  '' (plain CSV, default), 'gz' or 'zst'
+
+Readers do not depend on the setting: `find_segment_file('name.csv')` returns
+whichever of the variants exists, so directories holding a mix of plain and
+compressed segments keep working. zstd needs the optional `zstandard` package.
+
+"""
+
+import os, csv
+import gzip
+import socket
+import threading
+import shutil
+import contextlib
+
+SEGMENT_COMPRESSION = os.environ.get('MAILCHIMP_SEGMENT_COMPRESSION', '').strip('.')
+COMPRESSED_SUFFIXES = ['.gz', '.zst']
+GZIP_LEVEL = 3
+ZSTD_LEVEL = 3
+
+
+def segment_file(filename, compression=None):
+    """ Name under which a segment is written, e.g. 'name.csv' -> 'name.csv.gz' """
+
+    compression = SEGMENT_COMPRESSION if compression is None else compression
+    base = strip_compression(filename)
+
+    return base + '.' + compression if compression else base
+
+
+def strip_compression(filename):
+    """ 'name.csv.gz' -> 'name.csv' """
+
+    for suffix in COMPRESSED_SUFFIXES:
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)]
+
+    return filename
+
+
+def temp_segment_file(filename):
+    """ Temporary name with the same codec, e.g. 'name.csv.gz' -> 'name.csv.tmp-host-pid-thread.gz'
+
+    Unique per host, process and thread, so concurrent writers of the same file
+    (e.g. export workers sharing a mount) never write into each other's temporary file.
+    """
+
+    base = strip_compression(filename)
+    tag = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), threading.get_ident())
+
+    return base + '.tmp-' + tag + filename[len(base):]
+
+
+def find_segment_file(filename, directory='.'):
+    """ The existing variant of a segment file (plain, .gz or .zst), or None """
+
+    base = strip_compression(filename)
+    for candidate in [segment_file(base)] + [base] + [base + x for x in COMPRESSED_SUFFIXES]:
+        if os.path.isfile(os.path.join(directory, candidate)):
+            return candidate
+
+    return None
+
+
+def open_segment(filename, mode='r', encoding=None):
+    """ Open a segment file in text mode, (de)compressing according to its suffix
+
+    Reads strip a byte order mark (utf-8-sig), writes are plain utf-8.
+    """
+
+    if encoding is None:
+        encoding = 'utf-8-sig' if 'r' in mode else 'utf-8'
+    mode = mode.replace('b', '').replace('t', '') + 't'
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, compresslevel=GZIP_LEVEL, encoding=encoding, newline='')
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('Reading or writing ' + filename + ' needs the zstandard package (pip install zstandard)')
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL) if 'r' not in mode else None
+        return zstandard.open(filename, mode, cctx=cctx, encoding=encoding, newline='')
+
+    return open(filename, mode, encoding=encoding, newline='')
+
+
+def read_segment(filename, **kwargs):
+    """ DataFrame of a segment file of any codec, typed by segment_schema.py """
+
+    from segment_schema import read_segment_frame
+
+    with open_segment(filename) as fp:
+        return read_segment_frame(fp, **kwargs)
+
+
+@contextlib.contextmanager
+def write_segment_atomic(filename):
+    """ Open a segment file for writing; it only replaces filename once complete
+
+    Data goes to a temporary file that is renamed over filename when the block
+    finishes and removed when it fails, so a crash never leaves a partial segment.
+    Replacing (not truncating) also keeps hardlinked copies of the old file intact.
+    """
+
+    tmp = temp_segment_file(filename)
+    try:
+        with open_segment(tmp, 'w') as fp:
+            yield fp
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    os.replace(tmp, filename)
+
+
+def link_or_copy(src, dst):
+    """ Hardlink src to dst (replacing dst), copying where links are not possible """
+
+    tmp = temp_segment_file(dst)
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+    return dst
+
+
+def write_segment(dataframe, filename):
+    """ DataFrame.to_csv to a segment file of any codec, atomically """
+
+    with write_segment_atomic(filename) as fp:
+        dataframe.to_csv(fp, index=False)
+
+    return
+
+
+def row_key(row):
+    """ Hash of all fields of a CSV row, independent of the column order """
+
+    return hash(tuple(sorted((k, v or '') for k, v in row.items() if k is not None)))
+
+
+def merge_segment_files(all_segments_csv, filename, keep_row=None):
+    """ Concatenate segment files row by row into filename, streaming
+
+    The header of the first file is used; columns missing in later files are left
+    blank. Nothing is held in memory, so this works for segments of any size.
+    Rows for which keep_row(row) is false are left out.
+    """
+
+    with write_segment_atomic(filename) as out:
+        writer = None
+        for x in all_segments_csv:
+            with open_segment(x) as fp:
+                reader = csv.DictReader(fp)
+                if reader.fieldnames is None:
+                    continue
+                if writer is None:
+                    writer = csv.DictWriter(out, fieldnames=reader.fieldnames, restval='', extrasaction='ignore')
+                    writer.writeheader()
+                for row in reader:
+                    if keep_row is None or keep_row(row):
+                        writer.writerow(row)
+
+    return filename
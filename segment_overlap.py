@@ -0,0 +1,161 @@
+"""
+Overlap between segments, before deduplicating
+
+Usage:
+    python3 segment_overlap.py segments.csv [--dir All_segments] [--by-size] [--output segment_overlap]
+    python3 segment_overlap.py --files A.csv B.csv.gz ...
+
+Every email address is interned into a dense integer id and every segment
+becomes a bitset over those ids (one bit per member), so the overlap of two
+segments is the popcount of the AND of their bitsets. All pairs are computed
+with vectorized popcounts, one row of the matrix at a time. Written are
+
+    <output>.csv   one line per segment: members, unique (in no other segment),
+                   new (members not in any higher priority segment), then the
+                   overlap with every segment
+    <output>.json  the same as arrays
+
+Priority is the order of the segments file, or with --by-size the order
+deduplication.py uses (largest file first). All counts are of distinct email
+addresses, not rows: deduplication.py removes duplicate rows, and a member with
+several vehicles has several rows, so it may keep more rows than `new` says.
+
+"""
+
+import os, csv, ujson
+import argparse
+from pathlib import Path
+
+import segment_io
+
+PATH_SEGMENT = './All_segments'
+OUTPUT_PREFIX = 'segment_overlap'
+
+
+def read_segment_files(segment_file, directory):
+    """ Segment files named in the segments file (column 'Segment Name'), in its order """
+
+    with open(segment_file, "r") as csv_file:
+        names = [x['Segment Name'] for x in csv.DictReader(csv_file, delimiter=',')]
+    all_segments_csv = []
+    for name in names:
+        found = segment_io.find_segment_file(name + '.csv', directory)
+        if found is None:
+            print('No file for segment', name, 'in', directory, '- skipped')
+        else:
+            all_segments_csv.append(os.path.join(directory, found))
+
+    return all_segments_csv
+
+
+def intern_segments(all_segments_csv):
+    """ Member ids of every segment, with ids dense over all emails seen
+
+    Returns (list of sorted unique id arrays, number of distinct emails).
+    """
+
+    import numpy as np
+
+    ids = {}
+    all_segments_ids = []
+    for csvfile in all_segments_csv:
+        with segment_io.open_segment(csvfile) as fp:
+            reader = csv.reader(fp)
+            header = next(reader, None)
+            if header is None:
+                all_segments_ids.append(np.zeros(0, dtype=np.int64))
+                continue
+            column = header.index('email_address')
+            members = [ids.setdefault(row[column].strip().lower(), len(ids)) for row in reader if len(row) > column]
+        all_segments_ids.append(np.unique(np.array(members, dtype=np.int64)))
+
+    return all_segments_ids, len(ids)
+
+
+def popcount(words):
+    """ Number of set bits per row of a 2-d uint64 array """
+
+    import numpy as np
+
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    # numpy < 2.0: count per byte with a lookup table
+    table = np.array([bin(x).count('1') for x in range(256)], dtype=np.uint8)
+    return table[words.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def overlap_matrix(all_segments_ids, n_members):
+    """ Bitset per segment; returns (overlap matrix, members, unique, new in priority order) """
+
+    import numpy as np
+
+    n_words = max(1, (n_members + 63) // 64)
+    bits = np.zeros((len(all_segments_ids), n_words), dtype=np.uint64)
+    for k, x in enumerate(all_segments_ids):
+        np.bitwise_or.at(bits[k], x // 64, np.left_shift(np.uint64(1), (x % 64).astype(np.uint64)))
+
+    overlap = np.zeros((len(all_segments_ids), len(all_segments_ids)), dtype=np.int64)
+    for i in range(len(all_segments_ids)):
+        overlap[i, i:] = popcount(bits[i] & bits[i:])
+        overlap[i:, i] = overlap[i, i:]
+
+    members = np.diag(overlap).copy()
+    in_segments = np.bincount(np.concatenate(all_segments_ids), minlength=n_members) if all_segments_ids else np.zeros(0)
+    unique = np.array([int((in_segments[x] == 1).sum()) for x in all_segments_ids], dtype=np.int64)
+
+    seen = np.zeros(n_words, dtype=np.uint64)
+    new = np.zeros(len(all_segments_ids), dtype=np.int64)
+    for k in range(len(all_segments_ids)):
+        new[k] = popcount((bits[k] & ~seen)[None, :])[0]
+        seen |= bits[k]
+
+    return overlap, members, unique, new
+
+
+def write_overlap(names, overlap, members, unique, new, output_prefix):
+    """ Write <output_prefix>.csv and <output_prefix>.json """
+
+    with open(output_prefix + '.csv', 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['segment', 'members', 'unique', 'new'] + names)
+        for k, name in enumerate(names):
+            writer.writerow([name, members[k], unique[k], new[k]] + list(overlap[k]))
+
+    with open(output_prefix + '.json', 'w') as fp:
+        ujson.dump({'segments': names, 'members': members.tolist(), 'unique': unique.tolist(),
+                    'new': new.tolist(), 'overlap': overlap.tolist()}, fp, indent=4)
+
+    return
+
+
+# MAIN
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Overlap matrix of segment files')
+    parser.add_argument('segment_file', nargs='?', help='segments file with a "Segment Name" column')
+    parser.add_argument('--files', nargs='+', default=[], help='segment files, instead of a segments file')
+    parser.add_argument('--dir', default=PATH_SEGMENT, help='directory of the segment files')
+    parser.add_argument('--by-size', action='store_true', help='priority by file size, like deduplication.py')
+    parser.add_argument('--output', default=OUTPUT_PREFIX, help='prefix of the .csv and .json output')
+    args = parser.parse_args()
+
+    if args.files:
+        all_segments_csv = args.files
+    elif args.segment_file:
+        all_segments_csv = read_segment_files(args.segment_file, args.dir)
+    else:
+        parser.error('give a segments file or --files')
+    if args.by_size:
+        all_segments_csv = sorted(all_segments_csv, key=lambda x: Path(x).stat().st_size, reverse=True)
+
+    import metrics
+    with metrics.stage('segment_overlap') as stage_info:
+        all_segments_ids, n_members = intern_segments(all_segments_csv)
+        overlap, members, unique, new = overlap_matrix(all_segments_ids, n_members)
+        stage_info['rows'] = int(members.sum())
+
+    names = [os.path.splitext(segment_io.strip_compression(os.path.basename(x)))[0] for x in all_segments_csv]
+    write_overlap(names, overlap, members, unique, new, args.output)
+    print(len(names), 'segments,', int(members.sum()), 'segment members,', n_members, 'distinct members,',
+          int(new.sum()), 'members not in any higher priority segment')
+    print('Written', args.output + '.csv', 'and', args.output + '.json')
@@ -0,0 +1,99 @@
+"""
+Column types of segment frames
+
+The default pandas inference is both wasteful and wrong for segment exports:
+PROVINCE, MAKE, MODEL or status end up as object columns, YEAR becomes float64
+as soon as one value is blank, and ZIP codes may be parsed as numbers. Every
+DataFrame of a segment is therefore read with `read_segment_frame`:
+
+    - email, names and ZIP code: pandas string dtype (ZIP codes stay text)
+    - low-cardinality columns: categoricals
+    - YEAR: nullable Int16, blanks stay blank instead of becoming NaN or 9999
+
+Only empty fields are missing values, so names such as "NA" or "Null" are kept.
+Columns not listed in SEGMENT_DTYPES are read as strings.
+
+"""
+
+SEGMENT_DTYPES = {
+    'email_address': 'string',
+    'status': 'category',
+    'FNAME': 'string',
+    'LNAME': 'string',
+    'PROVINCE': 'category',
+    'CITY': 'category',
+    'ZIP_CODE': 'string',
+    'MAKE': 'category',
+    'MODEL': 'category',
+}
+SMALL_INT_COLUMNS = {'YEAR': 'Int16'}
+
+
+def read_segment_frame(fp, **kwargs):
+    """ pandas.read_csv with the segment schema applied """
+
+    import pandas as pd
+    from collections import defaultdict
+
+    dtype = defaultdict(lambda: 'string', SEGMENT_DTYPES)
+    frame = pd.read_csv(fp, dtype=dtype, keep_default_na=False, na_values=[''], **kwargs)
+    for column, small_int in SMALL_INT_COLUMNS.items():
+        if column in frame.columns:
+            frame[column] = to_small_int(frame[column], small_int)
+
+    return frame
+
+
+def to_small_int(series, dtype):
+    """ A string column as a nullable integer column, or unchanged if it holds anything but integers """
+
+    import pandas as pd
+
+    numbers = pd.to_numeric(series, errors='coerce')
+    if numbers.notna().sum() != series.notna().sum():
+        print('Column', series.name, 'has non-numeric values, kept as text')
+        return series
+    try:
+        return numbers.astype(dtype)
+    except (TypeError, ValueError, OverflowError):
+        print('Column', series.name, 'does not fit', dtype + ', kept as text')
+        return series
+
+
+def align_frames(frame_1, frame_2):
+    """ Give the common columns of two frames identical dtypes, so they can be merged on
+
+    Categoricals get the union of both category sets (merges then compare codes);
+    columns typed differently in the two frames (e.g. YEAR kept as text in one)
+    fall back to strings. Both frames are changed in place.
+    """
+
+    import pandas as pd
+    from pandas.api.types import union_categoricals
+
+    for column in frame_1.columns.intersection(frame_2.columns):
+        a, b = frame_1[column], frame_2[column]
+        if isinstance(a.dtype, pd.CategoricalDtype) and isinstance(b.dtype, pd.CategoricalDtype):
+            if not a.cat.categories.equals(b.cat.categories):
+                categories = union_categoricals([a, b], ignore_order=True).categories
+                frame_1[column] = a.cat.set_categories(categories)
+                frame_2[column] = b.cat.set_categories(categories)
+        elif a.dtype != b.dtype:
+            frame_1[column] = a.astype('string')
+            frame_2[column] = b.astype('string')
+
+    return frame_1, frame_2
+
+
+def row_keys(frame):
+    """ Hashable key of every row of a typed frame, equal where a merge on the typed columns matches
+
+    Values are compared as the strings align_frames falls back to (YEAR 2001 read
+    from "2001" or "2001.0" alike), and missing values as equal, as merge does.
+    Keys of frames with the same columns, in any order, can be compared.
+    """
+
+    columns = sorted(frame.columns)
+    values = [frame[c].astype('string').astype(object).where(frame[c].notna(), None) for c in columns]
+
+    return [hash(tuple(zip(columns, row))) for row in zip(*values)]
@@ -12,25 +12,37 @@ E-mail: prateek.goel@partsavatar.ca
 import os, sys, time
 from tqdm import tqdm
 import csv, ujson, hashlib
-import requests, io
+import io
 import zipfile, tarfile
 import socket
 import pandas as pd
+import threading
 from pathlib import Path
-from mailchimp3 import MailChimp
+from concurrent.futures import ThreadPoolExecutor
+import metrics
 from pprint import pprint
 
 PWD = os.getcwd()
 PATH_AUDIENCE = './All_segments_deduplicated'
-CREATE_NEW_AUDIENCE = False
-WRITE_AUDIENCE_MEMBERS = True
-
-# API key
-mc_api = " "
-
-# MailChimp client
-headers = requests.utils.default_headers()
-client = MailChimp(mc_api=mc_api, timeout=30.0, request_headers=headers)
+# Defaults, can be overridden from the environment (see pipeline.py)
+CREATE_NEW_AUDIENCE = os.environ.get('CREATE_NEW_AUDIENCE', 'False') == 'True'
+WRITE_AUDIENCE_MEMBERS = os.environ.get('WRITE_AUDIENCE_MEMBERS', 'True') == 'True'
+ASSUME_YES = os.environ.get('IMPORT_ASSUME_YES', 'False') == 'True'      # or --yes: no confirmation prompts
+SUBMITTED_BATCH_IDS_FILE = os.path.join(PWD, 'submitted_batch_ids')
+DUMP_MEMBERS_JSON = False
+UPSERT_MEMBERS = False
+SYNC_MEMBERS = False
+SYNC_DELETE_MISSING = False
+MAX_WORKERS = 8
+CONFIRM_EACH_AUDIENCE = False
+MAX_BATCHES_IN_FLIGHT = 4
+POLL_MIN_WAIT = 5
+POLL_MAX_WAIT = 120
+
+# MailChimp client, built on first use
+from mailchimp_client import client
+import metadata_cache
+import segment_io
 
 # List id
 TEMPLATE_LIST_ID = '776708c17f'
@@ -54,10 +66,10 @@ def get_all_lists(f = "lists.name,lists.id"):
 
 
 def get_list_by_id(listid):
-    """ Returns the list matching provided id
+    """ Returns the list matching provided id (cached, see metadata_cache.py)
     """
 
-    list_matching = client.lists.get(listid)
+    list_matching = metadata_cache.get_json('lists/' + listid)
     list_matching_output = ujson.dumps(list_matching, indent=4)
 
     return list_matching, list_matching_output
@@ -67,14 +79,15 @@ def delete_list_by_id(listid):
     """ Delete an entire audience matching provided id."""
 
     client.lists.delete(listid)
+    metadata_cache.invalidate('lists/' + listid)
 
     return
 
 
 def get_merge_fields_list(listid):
-    """ Given a list id, get all the merge fields"""
+    """ Given a list id, get all the merge fields (cached, see metadata_cache.py)"""
 
-    response = client.lists.merge_fields.all(listid, get_all=True)
+    response = metadata_cache.get_json('lists/' + listid + '/merge-fields', count=1000)
     all_merge_fields = response['merge_fields']
     n_merge_fields = len(all_merge_fields)
     merge_fields_info = []
@@ -91,6 +104,16 @@ def get_merge_fields_list(listid):
 
 
 
+def missing_merge_fields(listid, merge_fields):
+    """ Those of merge_fields whose tag the list does not have (read fresh, not from the cache)
+    """
+
+    response = metadata_cache.get_json('lists/' + listid + '/merge-fields', revalidate=True, count=1000)
+    tags = set(x['tag'] for x in response['merge_fields'])
+
+    return [x for x in merge_fields if x['tag'] not in tags]
+
+
 def add_merge_fields_to_list(listid, merge_fields_to_create):
     """ Add additional merge fields to an existing list
     """
@@ -103,6 +126,26 @@ def add_merge_fields_to_list(listid, merge_fields_to_create):
     return
 
 
+def add_merge_fields_to_lists_batch(fields_by_list):
+    """ Add merge fields to several lists with a single batch operation
+
+    fields_by_list maps list id -> merge fields to create. Replaces one blocking
+    create call per field and list. Returns the batch id, which can be followed
+    with check_batch.py or poll_batches.py.
+    """
+
+    operations = [{
+        'method': 'POST',
+        'path': '/lists/' + listid + '/merge-fields',
+        'body': ujson.dumps(field)
+    } for listid, merge_fields_to_create in fields_by_list.items() for field in merge_fields_to_create]
+
+    response = client.batch_operations.create(data={"operations": operations})
+    BATCH_ID = response["id"]
+
+    return BATCH_ID
+
+
 def get_all_members_subscribed_list(listid):
     """ Returns all members inside list."""
 
@@ -146,42 +189,309 @@ def create_new_list(list_name, company_contact, company_campaign_defaults, permi
     return response
 
 
-def create_members_list_batch(listid, csvfile):
-    """ Batch operation for creating multiple members at once from CSV file
+def read_members_from_csv(csvfile):
+    """ Generator over the members of a CSV file, one Mailchimp member body per row
     """
 
-    response = get_list_by_id(listid)
-    print('Will write new members to list', response[0]['name'])
-    text = input('Do you want to continue?: Type Yes\n')
+    primary_fields = ['email_address','status']
+
+    with segment_io.open_segment(csvfile) as csv_file:
+        reader = csv.DictReader(csv_file, skipinitialspace=True)
+        for row in reader:
+            d = {k: v for k, v in row.items() if k in primary_fields}
+            d['merge_fields'] = {k: v for k, v in row.items() if k not in primary_fields}
+            yield d
+
+
+def get_subscriber_hash(email_address):
+    """ MD5 hash of the lowercased email, the member id Mailchimp uses in URLs
+    """
+
+    return hashlib.md5(email_address.strip().lower().encode('utf-8')).hexdigest()
+
+
+def build_member_operations(listid, csvfile, debug_dump=False, upsert=False):
+    """ Generator streaming CSV rows straight into serialized batch operations
+
+    With upsert, every member is written with PUT on its subscriber hash instead
+    of POST, so the same file can be re-submitted (or split across workers) without
+    "Member Exists" errors. New members get their CSV status via status_if_new.
+
+    Every operation carries the member email as operation_id, so failures in the
+    batch response archive can be traced back to CSV rows (see batch_errors.py).
+
+    With debug_dump, every member body is also written (one per line) to a .jsonl
+    file next to the CSV, for inspection only. Nothing reads it back.
+    """
+
+    path = '/lists/' + listid + '/members'
+    dump = open(csvfile.split('.')[0]+'.jsonl', 'w') if debug_dump else None
+    try:
+        for member in read_members_from_csv(csvfile):
+            if upsert:
+                member['status_if_new'] = member['status']
+                body = ujson.dumps(member)
+                operation = {'method': 'PUT', 'path': path + '/' + get_subscriber_hash(member['email_address']), 'body': body}
+            else:
+                body = ujson.dumps(member)
+                operation = {'method': 'POST', 'path': path, 'body': body}
+            operation['operation_id'] = member['email_address']
+            if dump is not None:
+                dump.write(body + '\n')
+            yield operation
+    finally:
+        if dump is not None:
+            dump.close()
+
+
+def member_fingerprint(merge_fields, tags):
+    """ Hash of the values of the given merge field tags of a member
+
+    Values are compared as stripped strings, so 2015 from the API equals "2015" from the CSV.
+    """
+
+    values = ['' if merge_fields.get(tag) is None else str(merge_fields.get(tag)).strip() for tag in tags]
+
+    return hashlib.md5('\x1f'.join(values).encode('utf-8')).hexdigest()
+
+
+def get_list_fingerprints(listid, tags, count=1000):
+    """ Subscriber hash -> (status, merge field fingerprint) for every member currently in a list
+
+    Fetched page by page with only the fields needed for the fingerprint.
+    """
+
+    fingerprints = {}
+    offset = 0
+    while True:
+        response = client.lists.members.all(listid, count=count, offset=offset,
+                                            fields="members.id,members.status,members.merge_fields")
+        page = response['members']
+        for member in page:
+            fingerprints[member['id']] = (member['status'], member_fingerprint(member['merge_fields'], tags))
+        if len(page) < count:
+            break
+        offset = offset + count
+
+    return fingerprints
+
+
+def read_csv_merge_tags(csvfile):
+    """ Merge field tags in the header of a member CSV; ValueError if it has no header at all """
+
+    with segment_io.open_segment(csvfile) as csv_file:
+        header = next(csv.reader(csv_file, skipinitialspace=True), None)
+    if not header:
+        raise ValueError('{} has no header, refusing to sync it'.format(csvfile))
+
+    return sorted(x for x in header if x not in ['email_address', 'status'])
+
+
+def build_sync_operations(listid, csvfile, delete_missing=False):
+    """ Generator over the operations needed to make a list match a CSV file
+
+    Members not in the list are created, subscribed members whose status or merge
+    fields differ are updated with PATCH, and (with delete_missing) list members
+    absent from the CSV are archived with DELETE. Unchanged members produce nothing.
+
+    The status of members that are not subscribed in the list (unsubscribed,
+    cleaned, ...) is never changed: only their merge fields are updated. Only the
+    first row of an email is used. A CSV with a header but no rows is a valid,
+    empty audience (with delete_missing every list member is archived); a CSV
+    without a header raises ValueError.
+    """
+
+    path = '/lists/' + listid + '/members'
+    tags = read_csv_merge_tags(csvfile)
+    remote = get_list_fingerprints(listid, tags)
+    seen = set()
+    for member in read_members_from_csv(csvfile):
+        subscriber_hash = get_subscriber_hash(member['email_address'])
+        if subscriber_hash in seen:
+            print('Duplicate email in', csvfile, '-', member['email_address'], 'skipped')
+            continue
+        seen.add(subscriber_hash)
+        if subscriber_hash not in remote:
+            yield {'method': 'POST', 'path': path, 'body': ujson.dumps(member),
+                   'operation_id': member['email_address']}
+            continue
+        remote_status, remote_fingerprint = remote.pop(subscriber_hash)
+        fingerprint = member_fingerprint(member['merge_fields'], tags)
+        if remote_status != 'subscribed':
+            if remote_fingerprint != fingerprint:
+                yield {'method': 'PATCH', 'path': path + '/' + subscriber_hash,
+                       'body': ujson.dumps({'merge_fields': member['merge_fields']}),
+                       'operation_id': member['email_address']}
+        elif remote_fingerprint != fingerprint or member['status'] != remote_status:
+            yield {'method': 'PATCH', 'path': path + '/' + subscriber_hash, 'body': ujson.dumps(member),
+                   'operation_id': member['email_address']}
+
+    # Whatever is left in the list was not in the CSV
+    if delete_missing and remote:
+        for subscriber_hash in remote:
+            yield {'method': 'DELETE', 'path': path + '/' + subscriber_hash, 'operation_id': subscriber_hash}
+
+
+def create_new_lists(list_names, company_contact, company_campaign_defaults, permission_reminder, email_type_option):
+    """ Create several blank audiences concurrently, at most MAX_WORKERS at a time
+
+    Every audience is recorded in created_audience_info as soon as it is created,
+    so a failure of the others does not orphan it: re-running reuses it. Returns
+    the responses in the same order as list_names; raises RuntimeError naming the
+    audiences that could not be created.
+    """
+
+    def create_one(list_name):
+        print('Creating audience:', list_name)
+        response = create_new_list(list_name, company_contact, company_campaign_defaults,
+                                   permission_reminder, email_type_option)
+        record_created_audience(response['id'], list_name)
+        return response
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [executor.submit(create_one, x) for x in list_names]
+
+    responses = []
+    failed = []
+    for list_name, future in zip(list_names, futures):
+        try:
+            responses.append(future.result())
+        except Exception as e:
+            print('FAILED: creating audience', list_name, '-', repr(e))
+            failed.append(list_name)
+    if failed:
+        raise RuntimeError('Could not create audiences: ' + ', '.join(failed))
+
+    return responses
+
+
+_created_audience_lock = threading.Lock()
+
+
+def record_created_audience(listid, list_name, filename='created_audience_info'):
+    """ Append a created audience to created_audience_info (read by read_created_audience_info) """
+
+    with _created_audience_lock:
+        new_file = not os.path.isfile(filename)
+        with open(filename, 'a') as fp:
+            if new_file:
+                fp.write('ID      NAME\n')
+            fp.write('{}  {}\n'.format(listid, list_name))
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    return
+
+
+def read_created_audience_info(filename='created_audience_info'):
+    """ Audience name -> id of the audiences recorded by an earlier creation run ({} if none) """
+
+    created = {}
+    if os.path.isfile(filename):
+        for line in open(filename).readlines()[1:]:
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                created[parts[1].strip()] = parts[0]
+
+    return created
 
-    if text == 'Yes' or text == 'Y' or text == 'y':
-        primary_fields = ['email_address','status']
-        result = []
-        jsonfile = csvfile.split('.')[0]+'.json'
 
-        with open(csvfile, encoding='utf-8-sig') as csv_file:
-            reader = csv.DictReader(csv_file, skipinitialspace=True)
-            for row in reader:
-                d = {k: v for k, v in row.items() if k in primary_fields}
+def find_existing_audiences(list_names):
+    """ Audience name -> id of those list_names that already exist
 
-                d['merge_fields'] = {k: v for k, v in row.items() if k not in primary_fields}
-                result.append(d)  
-            with open(jsonfile, 'w')as fp:
-                ujson.dump(result, fp, indent=4)
+    Audiences recorded in created_audience_info by an earlier creation run are
+    reused while they are still in the account, so re-running the creation does
+    not create copies. Other audiences of the account that merely share a name
+    are reused only after a warning and confirmation.
+    """
+
+    account = {}
+    for lst in get_all_lists()[0]['lists']:
+        account.setdefault(lst['name'], []).append(lst['id'])
+    account_ids = set(x for ids in account.values() for x in ids)
+    recorded = read_created_audience_info()
+
+    existing = {}
+    unrecorded = {}
+    for name in dict.fromkeys(list_names):
+        if recorded.get(name) in account_ids:
+            existing[name] = recorded[name]
+        elif name in account:
+            unrecorded[name] = account[name][0]
+
+    if unrecorded:
+        print('WARNING: the account has audiences with these names, not created by this script:')
+        for name, listid in unrecorded.items():
+            print('   ', listid, name)
+        if confirm('Reuse them instead of creating new audiences?: Type Yes\n'):
+            existing.update(unrecorded)
+
+    return existing
+
+
+_batch_ids_lock = threading.Lock()
+
+
+def confirm(question='Do you want to continue?: Type Yes\n'):
+    """ Ask for confirmation on the terminal; always yes with ASSUME_YES (--yes, IMPORT_ASSUME_YES=True) """
 
+    if ASSUME_YES:
+        print(question.strip(), 'Yes (assumed)')
+        return True
+    text = input(question)
 
-        with open(jsonfile, "r") as read_file:
+    return text == 'Yes' or text == 'Y' or text == 'y'
 
-            data = ujson.load(read_file)
 
-            operations = [{
-                'method': 'POST',
-                'path': '/lists/' + listid + '/members',
-                'body': ujson.dumps(member)
-            } for member in data]
+def record_submitted_batch(batchid, listid, csvfile):
+    """ Append a batch id to SUBMITTED_BATCH_IDS_FILE right after it was submitted
+
+    One id per line, so the file can be given to poll_batches.py as it is, and
+    no batch is lost when the run fails later on.
+    """
+
+    with _batch_ids_lock:
+        with open(SUBMITTED_BATCH_IDS_FILE, 'a') as fp:
+            fp.write(batchid + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+    print('Submitted batch', batchid, 'for list', listid, 'from', csvfile, '- recorded in', SUBMITTED_BATCH_IDS_FILE)
+
+    return
+
+
+def submit_members_list_batch(listid, csvfile):
+    """ Build the member operations for a CSV file and submit them as one batch
+
+    With SYNC_MEMBERS only the difference to the current list contents is sent,
+    and no batch is submitted when the list is already up to date.
+    Returns (batch id or None, number of member operations).
+    """
 
-        response = client.batch_operations.create(data={"operations": operations})
-        BATCH_ID = response["id"]
+    if SYNC_MEMBERS:
+        operations = list(build_sync_operations(listid, csvfile, SYNC_DELETE_MISSING))
+        print('Sync of', csvfile, 'needs', len(operations), 'operations')
+        if not operations:
+            return None, 0
+    else:
+        operations = list(build_member_operations(listid, csvfile, DUMP_MEMBERS_JSON, UPSERT_MEMBERS))
+
+    response = client.batch_operations.create(data={"operations": operations})
+    BATCH_ID = response["id"]
+    record_submitted_batch(BATCH_ID, listid, csvfile)
+
+    return BATCH_ID, len(operations)
+
+
+def create_members_list_batch(listid, csvfile):
+    """ Batch operation for creating multiple members at once from CSV file
+    """
+
+    response = get_list_by_id(listid)
+    print('Will write new members to list', response[0]['name'])
+
+    if confirm():
+        BATCH_ID, _ = submit_members_list_batch(listid, csvfile)
         print('Current bath operation id:\n')
         print(BATCH_ID)
     else:
@@ -191,10 +501,18 @@ def create_members_list_batch(listid, csvfile):
 
 
 def check_batch_operation_status(batchid):
-    """ Get info on a submitted batch operation """
+    """ Get info on a submitted batch operation; (None, None) if the request failed
+
+    Uses the error tolerant status call of poll_batches.py: a timeout, 5xx or 429
+    is logged instead of raised, the batch keeps running on the server anyway.
+    """
+
+    import poll_batches
 
     # Get response
-    response = client.batch_operations.get(batchid)
+    response = poll_batches.get_batch_info(batchid)
+    if response is None:
+        return None, None
 
     # Extract status and other details from response
     status = response['status']
@@ -203,6 +521,77 @@ def check_batch_operation_status(batchid):
     return status, response_body_url
 
 
+def wait_for_batch_operation(batchid):
+    """ Block until a batch operation is finished, polling with exponential backoff
+
+    Failed status requests back off like unfinished ones; after MAX_POLL_ERRORS of
+    them in a row (poll_batches.py) the batch is left to poll_batches.py.
+    Returns the last status ('poll failed' then) and the response body URL.
+    """
+
+    from poll_batches import MAX_POLL_ERRORS
+
+    wait = POLL_MIN_WAIT
+    errors = 0
+    status, response_body_url = check_batch_operation_status(batchid)
+    while status != 'finished':
+        errors = errors + 1 if status is None else 0
+        if errors >= MAX_POLL_ERRORS:
+            print('Giving up on', batchid, 'after', errors, 'failed status requests, follow it with poll_batches.py')
+            return 'poll failed', None
+        time.sleep(wait)
+        wait = min(wait * 2, POLL_MAX_WAIT)
+        status, response_body_url = check_batch_operation_status(batchid)
+
+    return status, response_body_url
+
+
+def print_import_plan(import_plan):
+    """ Show the whole audience <- CSV mapping and ask for confirmation once
+    """
+
+    print('The following imports will be submitted:\n')
+    for listid, list_name, csvfile in import_plan:
+        if os.path.isfile(csvfile):
+            size = '{:.1f} MB'.format(Path(csvfile).stat().st_size / 1e6)
+        else:
+            size = 'MISSING'
+        print('{}  {:<40} <- {} ({})'.format(listid, list_name, csvfile, size))
+    print()
+
+    return confirm()
+
+
+def import_audiences(import_plan):
+    """ Submit the imports of all audiences, at most MAX_BATCHES_IN_FLIGHT at a time
+
+    A worker only picks up the next audience once its previous batch has finished,
+    so the number of unfinished batches never exceeds MAX_BATCHES_IN_FLIGHT.
+    Returns the batch ids in plan order (None for skipped audiences) and the
+    number of member operations submitted.
+    """
+
+    def import_one(plan_item):
+        listid, list_name, csvfile = plan_item
+        if not os.path.isfile(csvfile) or Path(csvfile).stat().st_size == 0:
+            print('Skipping', list_name, '- no such or empty file', csvfile)
+            return None, 0
+        batchid, n_operations = submit_members_list_batch(listid, csvfile)
+        if batchid is None:
+            print('Nothing to do for', list_name)
+            return None, 0
+        print('Submitted', csvfile, 'to', list_name, '- batch operation id', batchid)
+        status, _ = wait_for_batch_operation(batchid)
+        if status == 'finished':
+            print('Finished batch operation', batchid, 'for', list_name)
+        return batchid, n_operations
+
+    with ThreadPoolExecutor(max_workers=MAX_BATCHES_IN_FLIGHT) as executor:
+        results = list(executor.map(import_one, import_plan))
+
+    return [x[0] for x in results], sum(x[1] for x in results)
+
+
 
 # MAIN
 if __name__ == "__main__":
@@ -220,8 +609,10 @@ if __name__ == "__main__":
     pprint(template_merge_fields)
     print()
 
-    # Audiences filenames
+    # Audiences filenames; --yes answers every confirmation prompt
     audience_names_file = sys.argv[1]
+    if '--yes' in sys.argv[2:]:
+        ASSUME_YES = True
 
     # Get names from file
     all_audiences_name = []
@@ -239,28 +630,40 @@ if __name__ == "__main__":
 
     # Create new audience and write members
     if CREATE_NEW_AUDIENCE:
+        # Audiences that exist already (earlier run, or created by hand) are reused
+        existing_audiences = find_existing_audiences(all_audiences_name)
+        names_to_create = [x for x in dict.fromkeys(all_audiences_name) if x not in existing_audiences]
+        print(len(existing_audiences), 'audiences exist already,', len(names_to_create), 'to create\n')
+
+        # Create new audiences concurrently, take settings from template file
+        with metrics.stage('create_audiences') as stage_info:
+            all_new_audiences = create_new_lists(names_to_create, partsavatar_contact, partsavatar_campaign_defaults,\
+                                                 partsavatar_permission_reminder, partsavatar_email_type_option)
+            stage_info['rows'] = len(all_new_audiences)
+        print('Done creating audiences\n')
+        new_audiences_id = {name: x['id'] for name, x in zip(names_to_create, all_new_audiences)}
+
+        # Write list name and id to file, in the order of the audience file
         fwrite = open('created_audience_info', 'w+')
         fwrite.write('ID      NAME\n')
-        number_of_audiences = len(all_audiences_name)
-        for s in range(number_of_audiences):
-
-            # Create new audience, take settings from template file
-            current_list_name = all_audiences_name[s]
-            print('Creating audience:\n')
-            print(current_list_name)
-            current_audience = create_new_list(current_list_name, partsavatar_contact, partsavatar_campaign_defaults,\
-                                               partsavatar_permission_reminder, partsavatar_email_type_option)
-
-            print('Done creating audience\n')
-            # Get list id of the audience just created
-            current_list_id = current_audience['id']
-
-            # Write list name and id to file
+        for current_list_name in all_audiences_name:
+            current_list_id = existing_audiences.get(current_list_name) or new_audiences_id[current_list_name]
             fwrite.write('{}  {}\n'.format(current_list_id, current_list_name))
-
-            # Add merge tags
-            add_merge_fields_to_list(current_list_id, template_merge_fields)
         fwrite.close()
+
+        # Add merge tags in one batch: all of them to the new audiences, the missing ones to
+        # reused audiences (e.g. created by a run that stopped before its merge field batch)
+        reused_ids = sorted(set(existing_audiences.values()))
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            reused_missing = list(executor.map(lambda x: missing_merge_fields(x, template_merge_fields), reused_ids))
+        fields_by_list = {listid: fields for listid, fields in zip(reused_ids, reused_missing) if fields}
+        for listid in fields_by_list:
+            print('Audience', listid, 'is missing merge fields:', ', '.join(x['tag'] for x in fields_by_list[listid]))
+        fields_by_list.update((listid, template_merge_fields) for listid in new_audiences_id.values())
+        if fields_by_list:
+            merge_fields_batch_id = add_merge_fields_to_lists_batch(fields_by_list)
+            print('Merge fields batch operation id:\n')
+            print(merge_fields_batch_id)
     else:
         pass
 
@@ -274,29 +677,33 @@ if __name__ == "__main__":
             current_list_id = fread[s+1].split()[0]
             all_audiences_id.append(current_list_id)
 
-        # Start writing
+        # Start writing, from plain or compressed segment files
         os.chdir(PATH_AUDIENCE)
-        for s in range(number_of_audiences):
+        all_segments_csv = [segment_io.find_segment_file(x) or x for x in all_segments_csv]
+        if CONFIRM_EACH_AUDIENCE:
+            for s in range(number_of_audiences):
 
-            # Current directory
-            print('Current working directory:\n')
-            print(os.getcwd())
+                # Add members to list
+                print ('New members to follwing audience will be written:')
+                print(all_audiences_id[s])
+                print ('From this CSV file:')
+                print(all_segments_csv[s])
 
-            # Get list id of the audience just created
-            current_list_id = all_audiences_id[s]
-
-            # Get name of audience from id!
-            list_info, list_info_json = get_list_by_id(current_list_id)
-            current_list_name = list_info['name']
-
-            # Add members to list
-            print ('New members to follwing audience will be written:')
-            print(current_list_id,  current_list_name)
-            print ('From this CSV file:')
-            print(all_segments_csv[s])
-
-            # Check if segment csv file is empty
-            create_members_list_batch(current_list_id, all_segments_csv[s])
+                create_members_list_batch(all_audiences_id[s], all_segments_csv[s])
+        else:
+            # Get names of audiences from ids, then confirm the whole plan once
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                all_lists_info = list(executor.map(get_list_by_id, all_audiences_id))
+            import_plan = [(all_audiences_id[s], all_lists_info[s][0]['name'], all_segments_csv[s])
+                           for s in range(number_of_audiences)]
+
+            if print_import_plan(import_plan):
+                with metrics.stage('import_audiences') as stage_info:
+                    all_batch_ids, stage_info['rows'] = import_audiences(import_plan)
+                print('All batch operation ids:\n')
+                for batchid in all_batch_ids:
+                    if batchid is not None:
+                        print(batchid)
         os.chdir(PWD)
     else:
         pass